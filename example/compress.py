@@ -124,45 +124,13 @@ transform = transforms.Compose([
 ])
 
 
-def topkqi_mask(statedict_kqi: dict, percentage: float, top=True):
-    kqis = torch.cat(tuple(kqi.flatten() for kqi in statedict_kqi.values()), 0)
-    num_masked = int(percentage * len(kqis))
-    if top:
-        topk = torch.tensor(np.partition(kqis.cpu(), -num_masked)[-num_masked]) if abs(num_masked) > 1e-6 else max(kqis)
-        cnt = num_masked - sum(kqis > topk)
-    else:
-        num_remain = len(kqis) - num_masked
-        topk = torch.tensor(np.partition(kqis.cpu(), -num_remain)[-num_remain]) if abs(num_remain) > 1e-6 else max(kqis)
-        cnt = num_masked - sum(kqis < topk)
-    statedict_mask = {}
-    for key, value in statedict_kqi.items():
-        res = torch.ones(value.shape, dtype=bool)
-        if top:
-            res[value > topk] = False
-        else:
-            res[value < topk] = False
-        if cnt > 0:
-            idx = torch.where(value.flatten() == topk)[0]
-            if idx.shape[0] > cnt:
-                idx = torch.from_numpy(np.random.choice(idx.cpu().numpy(), int(cnt), replace=False))
-            res = res.flatten()
-            res[idx] = False
-            res = res.reshape(value.shape)
-            cnt -= idx.shape[0]
-        statedict_mask[key] = res
-    return statedict_mask
-
-
 def mask_model(model_builder, model_weight, per, top, significand_bits=3, exponent_bits=4):
     model = model_builder()
     x = torch.randn(1, 3, 224, 224)
-    model_params = {var: name for name, var in model.named_parameters()}
-    statedict_kqi = {}
-    for grad_fn, kqis in torchKQI.KQI_generator(model, x, device=args.gpu):
-        if 'AccumulateGrad' in grad_fn.name():
-            assert len(kqis) == 1
-            statedict_kqi[model_params[grad_fn.variable]] = kqis[0][0]
-    statedict_mask = topkqi_mask(statedict_kqi, per, top)
+    num_masked = int(per * sum(param.numel() for param in model.parameters()))
+    masks, kqis = torchKQI.topk(model, x, num_masked, largest=top, device=args.gpu, return_values=True)
+    statedict_mask = {key: ~mask for key, mask in masks.items()}
+    kqi_mask = sum(kqi.sum().item() for kqi in kqis.values())
     model = model_builder(weights=model_weight)
 
     state_dict = {}
@@ -179,8 +147,6 @@ def mask_model(model_builder, model_weight, per, top, significand_bits=3, expone
         else:
             state_dict[key] = value
 
-    kqi_mask_dict = {key: value * (~statedict_mask[key]) for key, value in statedict_kqi.items()}
-    kqi_mask = sum(torch.sum(v).item() for v in kqi_mask_dict.values())
     model.load_state_dict(state_dict=state_dict)
     top1_accuracy, top5_accuracy = evaluate_model(model, transform)
 
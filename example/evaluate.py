@@ -7,8 +7,12 @@ import pandas as pd
 import traceback
 import argparse
 import os
+import shutil
+import json
+import time
+import functools
+import multiprocessing
 from tqdm import tqdm
-import numpy as np
 
 
 Llama_2_7b_hf = {
@@ -906,22 +910,17 @@ Phi_3_mini_4k_instruct = {
 }
 
 
-def calculate_kqi_components(kqi, model, x, callback_func = lambda model, x: model(x), device=None, disk_cache_dir=None, model_name=None):
+def calculate_kqi_components(breakdown, model_name=None):
     kqi_list = {}
-
-    for grad_fn, kqis in tqdm(torchKQI.KQI_generator(model, x, callback_func, device=device, disk_cache_dir=disk_cache_dir), desc=f"Processing {model_name}"):
-        grad_name = str(grad_fn.name())
-        kqi_percentage = sum(map(lambda k: k.sum(), kqis)) / kqi * 100
-        num = sum(np.prod(k.size()) for k in kqis)
-
+    for grad_name, op in breakdown['ops'].items():
         target_key = 'parameters' if 'AccumulateGrad' in grad_name else grad_name
-        
+
         if target_key not in kqi_list:
             kqi_list[target_key] = [0.0, 0, 0]
 
-        kqi_list[target_key][0] += kqi_percentage
-        kqi_list[target_key][1] += num
-        kqi_list[target_key][2] += 1
+        kqi_list[target_key][0] += op['kqi'] / breakdown['kqi'] * 100
+        kqi_list[target_key][1] += op['numel']
+        kqi_list[target_key][2] += op['count']
 
     result_rows = []
     for key, val in kqi_list.items():
@@ -936,9 +935,155 @@ def calculate_kqi_components(kqi, model, x, callback_func = lambda model, x: mod
     return result_rows
 
 
-def task_ImageClassification(args):
-    x = torch.randn(1, 3, 224, 224)
+def calculate_module_components(breakdown, model_name=None):
+    return [{'Model Name': model_name,
+             'module': path,
+             'depth': path.count('.') + 1 if path else 0,
+             'percentage': module['kqi'] / breakdown['kqi'] * 100,
+             'self_percentage': module['self'] / breakdown['kqi'] * 100}
+            for path, module in breakdown.get('modules', {}).items()]
+
+
+def load_vision_model(model_fn, input_shape, callback_func=lambda model, x: model(x)):
+    return model_fn().eval(), torch.randn(*input_shape), callback_func
+
+
+def load_llm(config_dict, config_class):
+    config = config_class.from_dict(config_dict)
+    model = transformers.AutoModel.from_config(config).eval()
 
+    if 'max_position_embeddings' in config.__dict__:
+        sequence_length = config.max_position_embeddings
+    else:
+        sequence_length = config.n_positions
+    sequence_length = min(sequence_length, 4096)
+
+    batch_size = 1
+    if isinstance(config, transformers.T5Config):
+        x = {
+            'input_ids': torch.randint(0, config.vocab_size, (batch_size, sequence_length)),
+            'decoder_input_ids': torch.randint(0, config.vocab_size, (batch_size, sequence_length))
+        }
+        return model, x, lambda model, x: model(**x).last_hidden_state
+    x = torch.randint(0, config.vocab_size, (batch_size, sequence_length))
+    return model, x, llm_output
+
+
+def predict_cost(load):
+    # Parameter count of the model built on the meta device, which allocates no memory.
+    try:
+        with torch.device('meta'):
+            model, _, _ = load()
+        return sum(p.numel() for p in model.parameters())
+    except Exception:
+        return 0
+
+
+def write_json(file_path, record):
+    tmp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(record, file)
+    os.replace(tmp_path, file_path)
+
+
+def read_json(file_path):
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, 'r') as file:
+        return json.load(file)
+
+
+def run_model(task, model_name, result_file, device, disk_cache_dir, num_threads):
+    torch.set_num_threads(num_threads)
+    try:
+        model, x, callback_func = TASKS[task]()[model_name]()
+        if disk_cache_dir is not None:
+            disk_cache_dir = f'{disk_cache_dir}/{task}/{model_name}'
+            shutil.rmtree(disk_cache_dir, ignore_errors=True)  # Left behind by an attempt that was killed
+        record = {'Model Name': model_name, 'breakdown': torchKQI.KQI_breakdown(model, x, callback_func, device=device, disk_cache_dir=disk_cache_dir)}
+    except Exception:
+        record = {'Model Name': model_name, 'error': traceback.format_exc()}
+    write_json(result_file, record)
+
+
+def resident_memory(pid):
+    # Resident set size in bytes, read from procfs (Linux).
+    try:
+        with open(f'/proc/{pid}/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def export_csv(task, output_path):
+    records = [read_json(f'{output_path}/{task}/{model_name}.json') for model_name in TASKS[task]()]
+    records = [record for record in records if record is not None]
+
+    results = [[record['Model Name'], record['breakdown']['kqi']] for record in records if 'error' not in record]
+    pd.DataFrame(results, columns=['Model Name', 'KQI']).to_csv(f'{output_path}/{task}_results_kqi.csv', index=False)
+    components = [row for record in records if 'error' not in record for row in calculate_kqi_components(record['breakdown'], model_name=record['Model Name'])]
+    pd.DataFrame(components, columns=['Model Name', 'grad_fn', 'percentage', 'total_num', 'times']).to_csv(f'{output_path}/{task}_results_component.csv', index=False)
+    modules = [row for record in records if 'error' not in record for row in calculate_module_components(record['breakdown'], model_name=record['Model Name'])]
+    pd.DataFrame(modules, columns=['Model Name', 'module', 'depth', 'percentage', 'self_percentage']).to_csv(f'{output_path}/{task}_results_module.csv', index=False)
+    errors = [[record['Model Name'], record['error']] for record in records if 'error' in record]
+    pd.DataFrame(errors, columns=['Model Name', 'Error']).to_csv(f'{output_path}/{task}_errors.csv', index=False)
+
+
+def sweep(tasks, args):
+    """
+    Run every model of the given tasks in its own process, at most args.workers at a time and largest first.
+    Each model commits one JSON file under {output_path}/{task}/; models with a successful result are skipped on rerun.
+    """
+    jobs = []
+    for task in tasks:
+        os.makedirs(f'{args.output_path}/{task}', exist_ok=True)
+        for model_name, load in TASKS[task]().items():
+            result_file = f'{args.output_path}/{task}/{model_name}.json'
+            record = read_json(result_file)
+            if record is None or 'error' in record:
+                jobs.append((predict_cost(load), task, model_name, result_file))
+    jobs.sort(key=lambda job: job[0], reverse=True)
+
+    context = multiprocessing.get_context('spawn')
+    num_threads = max(1, (os.cpu_count() or 1) // args.workers)
+    running = {}
+    with tqdm(total=len(jobs), desc='Sweep') as bar:
+        while jobs or running:
+            while jobs and len(running) < args.workers:
+                _, task, model_name, result_file = jobs.pop(0)
+                if os.path.exists(result_file):
+                    os.remove(result_file)
+                process = context.Process(target=run_model, args=(task, model_name, result_file, args.gpu, args.disk_cache_dir, num_threads))
+                process.start()
+                running[process] = (model_name, result_file, time.time())
+            time.sleep(1)
+
+            for process, (model_name, result_file, start) in list(running.items()):
+                error = None
+                if process.is_alive():
+                    if args.time_limit is not None and time.time() - start > args.time_limit:
+                        error = f'Exceeded the time limit of {args.time_limit} seconds.'
+                    elif args.memory_limit is not None and resident_memory(process.pid) > args.memory_limit * 1024 ** 3:
+                        error = f'Exceeded the memory limit of {args.memory_limit} GB.'
+                    else:
+                        continue
+                    process.kill()
+                process.join()
+                if error is None and not os.path.exists(result_file):
+                    error = f'Worker exited with code {process.exitcode}.'
+                if error is not None:
+                    write_json(result_file, {'Model Name': model_name, 'error': error})
+                del running[process]
+                bar.update()
+
+    for task in tasks:
+        export_csv(task, args.output_path)
+
+
+def task_ImageClassification():
     model_fns = [
         torchvision.models.alexnet,
         torchvision.models.convnext_tiny, torchvision.models.convnext_small, torchvision.models.convnext_base, torchvision.models.convnext_large,
@@ -961,76 +1106,20 @@ def task_ImageClassification(args):
         torchvision.models.vit_b_16, torchvision.models.vit_b_32, torchvision.models.vit_l_16, torchvision.models.vit_l_32, torchvision.models.vit_h_14
     ]
 
-    results_file_kqi = f'{args.output_path}/ImageClassification_results_kqi.csv'
-    results_file_component = f'{args.output_path}/ImageClassification_results_component.csv'
-    errors_file = f'{args.output_path}/ImageClassification_errors.csv'
-
-    if not os.path.exists(results_file_kqi):
-        pd.DataFrame(columns=['Model Name', 'KQI']).to_csv(results_file_kqi, index=False)
-    if not os.path.exists(results_file_component):
-        pd.DataFrame(columns=['Model Name', 'grad_fn', 'percentage', 'total_num', 'times']).to_csv(results_file_component, index=False)
-    if not os.path.exists(errors_file):
-        pd.DataFrame(columns=['Model Name', 'Error']).to_csv(errors_file, index=False)
-
-    for model_fn in model_fns:
-        if model_fn.__name__ in pd.read_csv(results_file_kqi)['Model Name'].values:
-            continue
-        try:
-            model = model_fn().eval()
-            kqi = torchKQI.KQI(model, x, device=args.gpu).item()
-            result = pd.DataFrame([[model_fn.__name__, kqi]], columns=['Model Name', 'KQI'])
-            result.to_csv(results_file_kqi, mode='a', header=False, index=False)
-
-            result_rows = calculate_kqi_components(kqi, model, x, device=args.gpu, disk_cache_dir=args.disk_cache_dir, model_name=model_fn.__name__)
-            result = pd.DataFrame(result_rows)
-            result.to_csv(results_file_component, mode='a', index=False, header=False)
-
-        except Exception:
-            error = pd.DataFrame([[model_fn.__name__, traceback.format_exc()]], columns=['Model Name', 'Error'])
-            error.to_csv(errors_file, mode='a', header=False, index=False)
-
+    return {model_fn.__name__: functools.partial(load_vision_model, model_fn, (1, 3, 224, 224)) for model_fn in model_fns}
 
-def task_SemanticSegmentation(args):
-    x = torch.randn(1, 3, 224, 224)
 
+def task_SemanticSegmentation():
     model_fns = [
         torchvision.models.segmentation.deeplabv3_mobilenet_v3_large, torchvision.models.segmentation.deeplabv3_resnet50, torchvision.models.segmentation.deeplabv3_resnet101,
         torchvision.models.segmentation.fcn_resnet50, torchvision.models.segmentation.fcn_resnet101,
         torchvision.models.segmentation.lraspp_mobilenet_v3_large,
     ]
 
-    results_file_kqi = f'{args.output_path}/SemanticSegmentation_results_kqi.csv'
-    results_file_component = f'{args.output_path}/SemanticSegmentation_results_component.csv'
-    errors_file = f'{args.output_path}/SemanticSegmentation_errors.csv'
+    return {model_fn.__name__: functools.partial(load_vision_model, model_fn, (1, 3, 224, 224), lambda model, x: model(x)['out']) for model_fn in model_fns}
 
-    if not os.path.exists(results_file_kqi):
-        pd.DataFrame(columns=['Model Name', 'KQI']).to_csv(results_file_kqi, index=False)
-    if not os.path.exists(results_file_component):
-        pd.DataFrame(columns=['Model Name', 'grad_fn', 'percentage', 'total_num', 'times']).to_csv(results_file_component, index=False)
-    if not os.path.exists(errors_file):
-        pd.DataFrame(columns=['Model Name', 'Error']).to_csv(errors_file, index=False)
-
-    for model_fn in model_fns:
-        if model_fn.__name__ in pd.read_csv(results_file_kqi)['Model Name'].values:
-            continue
-        try:
-            model = model_fn().eval()
-            kqi = torchKQI.KQI(model, x, lambda model, x: model(x)['out'], device=args.gpu).item()
-            result = pd.DataFrame([[model_fn.__name__, kqi]], columns=['Model Name', 'KQI'])
-            result.to_csv(results_file_kqi, mode='a', header=False, index=False)
-
-            result_rows = calculate_kqi_components(kqi, model, x, lambda model, x: model(x)['out'], device=args.gpu, disk_cache_dir=args.disk_cache_dir, model_name=model_fn.__name__)
-            result = pd.DataFrame(result_rows)
-            result.to_csv(results_file_component, mode='a', index=False, header=False)
-
-        except Exception:
-            error = pd.DataFrame([[model_fn.__name__, traceback.format_exc()]], columns=['Model Name', 'Error'])
-            error.to_csv(errors_file, mode='a', header=False, index=False)
-
-
-def task_ObjectDetection(args):
-    x = torch.randn(1, 3, 300, 300)
 
+def task_ObjectDetection():
     model_fns = [
         torchvision.models.detection.fasterrcnn_resnet50_fpn, torchvision.models.detection.fasterrcnn_mobilenet_v3_large_fpn, torchvision.models.detection.fasterrcnn_mobilenet_v3_large_320_fpn, torchvision.models.detection.fasterrcnn_resnet50_fpn_v2,
         torchvision.models.detection.fcos_resnet50_fpn,
@@ -1038,38 +1127,10 @@ def task_ObjectDetection(args):
         torchvision.models.detection.ssdlite320_mobilenet_v3_large,
     ]
 
-    results_file_kqi = f'{args.output_path}/ObjectDetection_results_kqi.csv'
-    results_file_component = f'{args.output_path}/ObjectDetection_results_component.csv'
-    errors_file = f'{args.output_path}/ObjectDetection_errors.csv'
-
-    if not os.path.exists(results_file_kqi):
-        pd.DataFrame(columns=['Model Name', 'KQI']).to_csv(results_file_kqi, index=False)
-    if not os.path.exists(results_file_component):
-        pd.DataFrame(columns=['Model Name', 'grad_fn', 'percentage', 'total_num', 'times']).to_csv(results_file_component, index=False)
-    if not os.path.exists(errors_file):
-        pd.DataFrame(columns=['Model Name', 'Error']).to_csv(errors_file, index=False)
-
-    for model_fn in model_fns:
-        if model_fn.__name__ in pd.read_csv(results_file_kqi)['Model Name'].values:
-            continue
-        try:
-            model = model_fn().eval()
-            kqi = torchKQI.KQI(model, x, lambda model, x: model(x)[0]['boxes'], device=args.gpu).item()
-            result = pd.DataFrame([[model_fn.__name__, kqi]], columns=['Model Name', 'KQI'])
-            result.to_csv(results_file_kqi, mode='a', header=False, index=False)
-            
-            result_rows = calculate_kqi_components(kqi, model, x, lambda model, x: model(x)[0]['boxes'], device=args.gpu, disk_cache_dir=args.disk_cache_dir, model_name=model_fn.__name__)
-            result = pd.DataFrame(result_rows)
-            result.to_csv(results_file_component, mode='a', index=False, header=False)
-            
-        except Exception:
-            error = pd.DataFrame([[model_fn.__name__, traceback.format_exc()]], columns=['Model Name', 'Error'])
-            error.to_csv(errors_file, mode='a', header=False, index=False)
-
-
-def task_VideoClassification(args):
-    x = torch.randn(1, 3, 16, 224, 224)
+    return {model_fn.__name__: functools.partial(load_vision_model, model_fn, (1, 3, 300, 300), lambda model, x: model(x)[0]['boxes']) for model_fn in model_fns}
+
 
+def task_VideoClassification():
     model_fns = [
         torchvision.models.video.mvit_v1_b, torchvision.models.video.mvit_v2_s,
         torchvision.models.video.r3d_18, torchvision.models.video.mc3_18, torchvision.models.video.r2plus1d_18,
@@ -1077,36 +1138,15 @@ def task_VideoClassification(args):
         torchvision.models.video.swin3d_t, torchvision.models.video.swin3d_s, torchvision.models.video.swin3d_b
     ]
 
-    results_file_kqi = f'{args.output_path}/VideoClassification_results_kqi.csv'
-    results_file_component = f'{args.output_path}/VideoClassification_results_component.csv'
-    errors_file = f'{args.output_path}/VideoClassification_errors.csv'
-
-    if not os.path.exists(results_file_kqi):
-        pd.DataFrame(columns=['Model Name', 'KQI']).to_csv(results_file_kqi, index=False)
-    if not os.path.exists(results_file_component):
-        pd.DataFrame(columns=['Model Name', 'grad_fn', 'percentage', 'total_num', 'times']).to_csv(results_file_component, index=False)
-    if not os.path.exists(errors_file):
-        pd.DataFrame(columns=['Model Name', 'Error']).to_csv(errors_file, index=False)
-
-    for model_fn in model_fns:
-        if model_fn.__name__ in pd.read_csv(results_file_kqi)['Model Name'].values:
-            continue
-        try:
-            model = model_fn().eval()
-            kqi = torchKQI.KQI(model, x, device=args.gpu).item()
-            result = pd.DataFrame([[model_fn.__name__, kqi]], columns=['Model Name', 'KQI'])
-            result.to_csv(results_file_kqi, mode='a', header=False, index=False)
-            
-            result_rows = calculate_kqi_components(kqi, model, x, device=args.gpu, disk_cache_dir=args.disk_cache_dir, model_name=model_fn.__name__)
-            result = pd.DataFrame(result_rows)
-            result.to_csv(results_file_component, mode='a', index=False, header=False)
-
-        except Exception:
-            error = pd.DataFrame([[model_fn.__name__, traceback.format_exc()]], columns=['Model Name', 'Error'])
-            error.to_csv(errors_file, mode='a', header=False, index=False)
-
-
-def task_LLM(args):
+    return {model_fn.__name__: functools.partial(load_vision_model, model_fn, (1, 3, 16, 224, 224)) for model_fn in model_fns}
+
+
+def llm_output(model, x):
+    output = model(x)
+    return output.logits if isinstance(output, CausalLMOutputWithPast) else output.last_hidden_state
+
+
+def task_LLM():
     llm_configs = {
         "bert_base_uncased": (bert_base_uncased, transformers.BertConfig),
         "bert_large_uncased": (bert_large_uncased, transformers.BertConfig),
@@ -1139,53 +1179,16 @@ def task_LLM(args):
         "Phi_3_mini_4k_instruct": (Phi_3_mini_4k_instruct, transformers.Phi3Config),
     }
 
-    results_file_kqi = f'{args.output_path}/LLM_results_kqi.csv'
-    results_file_component = f'{args.output_path}/LLM_results_component.csv'
-    errors_file = f'{args.output_path}/LLM_errors.csv'
-
-    if not os.path.exists(results_file_kqi):
-        pd.DataFrame(columns=['Model Name', 'KQI']).to_csv(results_file_kqi, index=False)
-    if not os.path.exists(results_file_component):
-        pd.DataFrame(columns=['Model Name', 'grad_fn', 'percentage', 'total_num', 'times']).to_csv(results_file_component, index=False)
-    if not os.path.exists(errors_file):
-        pd.DataFrame(columns=['Model Name', 'Error']).to_csv(errors_file, index=False)
-
-    for llm_name, llm_config in llm_configs.items():
-        if llm_name in pd.read_csv(results_file_kqi)['Model Name'].values:
-            continue
-        try:
-            config = llm_config[1].from_dict(llm_config[0])
-            model = transformers.AutoModel.from_config(config).eval()
-
-            if 'max_position_embeddings' in config.__dict__:
-                sequence_length = config.max_position_embeddings
-            else:
-                sequence_length = config.n_positions
-            sequence_length = min(sequence_length, 4096)
-
-            batch_size = 1
-            if isinstance(config, transformers.T5Config):
-                x = {
-                    'input_ids': torch.randint(0, config.vocab_size, (batch_size, sequence_length)),
-                    'decoder_input_ids': torch.randint(0, config.vocab_size, (batch_size, sequence_length))
-                }
-                callback_func = lambda model, x: model(**x).last_hidden_state
-                kqi = torchKQI.KQI(model, x, callback_func, device=args.gpu, disk_cache_dir=args.disk_cache_dir).item()
-            else:
-                x = torch.randint(0, config.vocab_size, (batch_size, sequence_length))
-                callback_func = lambda model, x: model(x).logits if isinstance(model(x), CausalLMOutputWithPast) else model(x).last_hidden_state
-
-                kqi = torchKQI.KQI(model, x, callback_func, device=args.gpu, disk_cache_dir=args.disk_cache_dir).item()
-            result = pd.DataFrame([[llm_name, kqi]], columns=['Model Name', 'KQI'])
-            result.to_csv(results_file_kqi, mode='a', header=False, index=False)
-            
-            result_rows = calculate_kqi_components(kqi, model, x, callback_func, device=args.gpu, disk_cache_dir=args.disk_cache_dir, model_name=llm_name)
-            result = pd.DataFrame(result_rows)
-            result.to_csv(results_file_component, mode='a', index=False, header=False)
-
-        except Exception:
-            error = pd.DataFrame([[llm_name, traceback.format_exc()]], columns=['Model Name', 'Error'])
-            error.to_csv(errors_file, mode='a', header=False, index=False)
+    return {llm_name: functools.partial(load_llm, *llm_config) for llm_name, llm_config in llm_configs.items()}
+
+
+TASKS = {
+    'ImageClassification': task_ImageClassification,
+    'SemanticSegmentation': task_SemanticSegmentation,
+    'ObjectDetection': task_ObjectDetection,
+    'VideoClassification': task_VideoClassification,
+    'LLM': task_LLM,
+}
 
 
 if __name__ == '__main__':
@@ -1193,6 +1196,10 @@ if __name__ == '__main__':
     parser.add_argument("--output_path", type=str, required=False, default='./result', help="Output file path.")
     parser.add_argument("--gpu", type=str, required=False, default=None, help="GPU ID (for example, 0 or 0,1). Default to CPU.")
     parser.add_argument("--disk_cache_dir", type=str, required=False, default=None, help="Disk cache to intermediate results. Reduce memory usage, but reduce performance.")
+    parser.add_argument("--tasks", type=str, nargs='+', required=False, default=list(TASKS), choices=list(TASKS), help="Tasks to sweep. Default to all.")
+    parser.add_argument("--workers", type=int, required=False, default=1, help="Number of models computed in parallel, each in its own process.")
+    parser.add_argument("--time_limit", type=float, required=False, default=None, help="Seconds after which a model is stopped and recorded as an error.")
+    parser.add_argument("--memory_limit", type=float, required=False, default=None, help="Resident memory in GB above which a model is stopped and recorded as an error.")
     args = parser.parse_args()
     if args.gpu is None:
         args.gpu = torch.device('cpu')
@@ -1201,8 +1208,4 @@ if __name__ == '__main__':
     if not os.path.exists(args.output_path):
         os.mkdir(args.output_path)
 
-    task_ImageClassification(args)
-    task_SemanticSegmentation(args)
-    task_ObjectDetection(args)
-    task_VideoClassification(args)
-    task_LLM(args)
+    sweep(args.tasks, args)
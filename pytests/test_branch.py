@@ -20,5 +20,59 @@ def test_Branch():
     testtool.testKQI(TestBranch(), torch.randn(1, 8 * 8))
 
 
+def test_ElementwiseChain():
+    class TestElementwiseChain(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.linear1 = torch.nn.Linear(in_features=64, out_features=32, bias=False)
+            self.linear2 = torch.nn.Linear(in_features=32, out_features=10, bias=False)
+
+        def forward(self, x):
+            x = torch.relu(self.linear1(x))
+            y = torch.sigmoid(torch.tanh(-x)) * 2
+            x = self.linear2(y + x)
+
+            return torch.tanh(torch.sigmoid(x))
+
+    testtool.testKQI(TestElementwiseChain(), torch.randn(1, 8 * 8))
+
+
+def test_ViewChain():
+    class TestViewChain(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.linear1 = torch.nn.Linear(in_features=64, out_features=32, bias=False)
+            self.linear2 = torch.nn.Linear(in_features=8, out_features=10, bias=False)
+
+        def forward(self, x):
+            x = self.linear1(x).view(2, 4, 4).transpose(0, 1).relu()
+            x = x.permute(2, 0, 1).unsqueeze(0).squeeze(0).reshape(4, 8)
+            x = self.linear2(x.t().contiguous().view(8, 4).t() + x.sigmoid())
+
+            return x
+
+    testtool.testKQI(TestViewChain(), torch.randn(1, 8 * 8))
+
+
+def test_Broadcast():
+    class TestBroadcast(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.linear1 = torch.nn.Linear(in_features=64, out_features=32, bias=False)
+            self.linear2 = torch.nn.Linear(in_features=32, out_features=10, bias=False)
+
+        def forward(self, x):
+            x = self.linear1(x).view(4, 8)
+            x = x.sum(1, keepdim=True).expand(4, 8) * x.softmax(0)
+            x = self.linear2(x.reshape(1, 32))
+
+            return x
+
+    testtool.testKQI(TestBroadcast(), torch.randn(1, 8 * 8))
+
+
 if __name__ == '__main__':
     test_Branch()
+    test_ElementwiseChain()
+    test_ViewChain()
+    test_Broadcast()
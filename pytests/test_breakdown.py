@@ -0,0 +1,44 @@
+import torch
+import torchKQI
+import math
+from collections import OrderedDict
+
+
+def test_breakdown():
+    model = torch.nn.Sequential(torch.nn.Linear(8, 6), torch.nn.Tanh(), torch.nn.Linear(6, 4), torch.nn.Tanh(), torch.nn.Linear(4, 3))
+    x = torch.randn(2, 8)
+    kqi = torchKQI.KQI(model, x)
+    breakdown = torchKQI.KQI_breakdown(model, x)
+    assert math.isclose(breakdown['kqi'], kqi, rel_tol=1e-6)
+    assert math.isclose(sum(op['kqi'] for op in breakdown['ops'].values()), kqi, rel_tol=1e-6)
+    assert set(breakdown['parameters']) == {name for name, _ in model.named_parameters()}
+    assert math.isclose(sum(breakdown['parameters'].values()), breakdown['ops']['torch::autograd::AccumulateGrad']['kqi'], rel_tol=1e-6)
+    # One entry per op type, with the elements and nodes of all its instances.
+    assert {name: (op['numel'], op['count']) for name, op in breakdown['ops'].items() if name != 'torch::autograd::AccumulateGrad'} == \
+        {'AddmmBackward0': (2 * 6 + 2 * 4 + 2 * 3, 3), 'TanhBackward0': (2 * 6 + 2 * 4, 2), 'TBackward0': (6 * 8 + 4 * 6 + 3 * 4, 3)}
+
+
+def test_module_breakdown():
+    class Block(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.conv = torch.nn.Conv2d(3, 4, kernel_size=3, padding=1)
+            self.fc = torch.nn.Linear(4 * 4 * 4, 10)
+
+        def forward(self, x):
+            return self.fc(torch.relu(self.conv(x)).flatten(1))
+
+    model, x = torch.nn.Sequential(OrderedDict(block=Block(), softmax=torch.nn.Softmax(-1), head=torch.nn.Linear(10, 3))), torch.randn(1, 3, 4, 4)
+    modules = torchKQI.KQI_breakdown(model, x)['modules']
+    kqi = torchKQI.KQI(model, x)
+    assert set(modules) == {'', 'block', 'block.conv', 'block.fc', 'softmax', 'head'}
+    assert math.isclose(modules['']['kqi'], kqi, rel_tol=1e-6) and modules['']['self'] == 0
+    assert math.isclose(sum(module['self'] for module in modules.values()), kqi, rel_tol=1e-6)
+    # The relu and flatten of Block.forward are its own nodes, while those of its submodules only add to its total.
+    assert math.isclose(modules['block']['kqi'], sum(modules[path]['self'] for path in ('block', 'block.conv', 'block.fc')), rel_tol=1e-6)
+    assert all(modules[path]['self'] > 0 for path in ('block', 'block.conv', 'block.fc', 'softmax', 'head'))
+
+
+if __name__ == '__main__':
+    test_breakdown()
+    test_module_breakdown()
@@ -0,0 +1,48 @@
+import torch
+import torchKQI
+import math
+import tempfile
+import pathlib
+import concurrent.futures
+from torchKQI import cache
+
+
+def test_result_cache(tmp_path):
+    def build():
+        return torch.nn.Sequential(torch.nn.Linear(8, 6), torch.nn.Tanh(), torch.nn.Linear(6, 3))
+
+    hits = []
+
+    def breakdown(model, x, **kwargs):
+        events = []
+        result = torchKQI.KQI_breakdown(model, x, cache_dir=str(tmp_path), events=events.append, **kwargs)
+        hits.append(bool(events[-1].get('cached')))
+        return result
+
+    model, x = build(), torch.randn(2, 8)
+    kqi = torchKQI.KQI(model, x)
+    assert math.isclose(breakdown(model, x)['kqi'], kqi, rel_tol=1e-6)
+    # Other weights and input values of the same architecture and shapes share the result; another shape does not.
+    assert math.isclose(breakdown(build(), torch.randn(2, 8))['kqi'], kqi, rel_tol=1e-6)
+    breakdown(model, torch.randn(3, 8))
+    assert hits == [False, True, False] and len(list(tmp_path.glob('*.json'))) == 2
+    assert math.isclose(torchKQI.KQI(build(), x, cache_dir=str(tmp_path)), kqi, rel_tol=1e-6)
+
+    # A result stored without tensors is computed again the first time they are asked for.
+    result = breakdown(model, x, parameter_tensors=True)
+    assert {name: tensor.shape for name, tensor in result['tensors'].items()} == {name: var.shape for name, var in model.named_parameters()}
+    assert all(math.isclose(result['tensors'][name].sum(), k, rel_tol=1e-6) for name, k in result['parameters'].items())
+    cached = breakdown(build(), x, parameter_tensors=True)
+    assert all(torch.equal(cached['tensors'][name], tensor) for name, tensor in result['tensors'].items())
+    assert hits[3:] == [False, True] and len(list(tmp_path.glob('*.pt'))) == 1
+    assert all(path.stat().st_mode & 0o777 == cache.FILE_MODE for path in tmp_path.iterdir())
+
+    store = cache.ResultCache(str(tmp_path / 'threads'))
+    result = {'kqi': list(range(1 << 16))}
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda _: store.store('key', result), range(32)))
+    assert store.load('key') == result and [path.name for path in (tmp_path / 'threads').iterdir()] == ['key.json']
+
+
+if __name__ == '__main__':
+    test_result_cache(pathlib.Path(tempfile.mkdtemp()))
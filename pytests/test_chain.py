@@ -0,0 +1,37 @@
+import torch
+import testtool
+from torchKQI import kqi, function_base
+
+
+class TestView(torch.nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.linear1 = torch.nn.Linear(in_features=16, out_features=16, bias=False)
+        self.linear2 = torch.nn.Linear(in_features=4, out_features=4, bias=False)
+
+    def forward(self, x):
+        return self.linear2(self.linear1(x).view(4, 4))
+
+
+@function_base.isolated
+def volumes(model, x):
+    model_output = kqi.__prepare(model, x, lambda model, x: model(x), torch.device('cpu'))
+    return {grad_fn: vs[0] for grad_fn, _, vs in kqi.__intermediate_result_generator(model_output)}
+
+
+def test_view_aliasing():
+    # The volume of the view is advanced in place into that of the producer it is the only consumer of.
+    vs = volumes(TestView(), torch.randn(1, 16))
+    (view, ) = (grad_fn for grad_fn in vs if grad_fn.name() == 'ViewBackward0')
+    assert view.next_functions[0][0].name() == 'MmBackward0'
+    assert vs[view].data_ptr() == vs[view.next_functions[0][0]].data_ptr()
+    testtool.testKQI(TestView(), torch.randn(1, 16))
+
+
+def test_view_shared_input():
+    class TestSharedView(TestView):
+        def forward(self, x):
+            y = self.linear1(x)
+            return self.linear2(y.view(4, 4)) + y.view(4, 4).t()
+
+    testtool.testKQI(TestSharedView(), torch.randn(1, 16))
@@ -0,0 +1,58 @@
+import torch
+import torchKQI
+import math
+import tempfile
+import pathlib
+import threading
+import urllib.request
+from torchKQI import daemon
+
+
+def test_daemon(tmp_path):
+    loads = []
+
+    def load_embedding(ids=(1, 2, 3, 2, 1)):
+        loads.append(ids)
+        model = torch.nn.Sequential(torch.nn.Embedding(10, 4), torch.nn.Linear(4, 3))
+        return model, torch.tensor([ids]), lambda model, x: model(x)[:, -1]
+
+    server = daemon.Daemon(str(tmp_path / 'store'), {'Test/embedding': load_embedding}, token='secret').serve(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = f'127.0.0.1:{server.server_address[1]}'
+    try:
+        first = daemon.request(address, 'secret', '/query', {'model': 'Test/embedding'})
+        assert first['state'] == 'done' and not first['result']['cached']
+        assert math.isclose(first['result']['kqi'], torchKQI.KQI(*load_embedding()).item(), rel_tol=1e-6)
+
+        job = daemon.request(address, 'secret', '/jobs', {'model': 'Test/embedding'})['id']
+        second = daemon.request(address, 'secret', f'/jobs/{job}?wait')
+        assert second['result']['cached'] and second['result']['kqi'] == first['result']['kqi']
+        assert len(loads) == 2  # The daemon traced the model once, the other load is the reference above
+        assert daemon.request(address, 'secret', '/stats') == {'jobs': 2, 'pending': 0, 'models': 1}
+        assert daemon.request(address, 'secret', '/models') == ['Test/embedding']
+
+        assert 'error' in daemon.request(address, 'secret', '/query', {'model': 'subprocess:getoutput', 'kwargs': {'cmd': 'true'}})
+        assert 'error' in daemon.request(address, 'secret', '/jobs/missing')
+        assert 'error' in daemon.request(address, 'wrong', '/stats')
+        http_request = urllib.request.Request(f'http://{address}/query', data=b'{"model": "Test/embedding"}', headers={'Content-Type': 'text/plain', 'Authorization': 'Bearer secret'})
+        try:
+            urllib.request.urlopen(http_request)
+            assert False
+        except urllib.error.HTTPError as err:
+            assert err.code == 415
+        assert daemon.request(address, 'secret', '/stats')['jobs'] == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # A loader building another input under the same name gets its own result from the same store.
+    changed = daemon.Daemon(str(tmp_path / 'store'), {'Test/embedding': lambda: load_embedding((1, 2, 3, 4, 5))})
+    third = changed.status(changed.submit({'model': 'Test/embedding'}), wait=True)
+    assert not third['result']['cached'] and not math.isclose(third['result']['kqi'], first['result']['kqi'], rel_tol=1e-6)
+    assert math.isclose(third['result']['kqi'], torchKQI.KQI(*load_embedding((1, 2, 3, 4, 5))).item(), rel_tol=1e-6)
+    again = changed.status(changed.submit({'model': 'Test/embedding'}), wait=True)
+    assert again['result']['cached'] and len(loads) == 4
+
+
+if __name__ == '__main__':
+    test_daemon(pathlib.Path(tempfile.mkdtemp()))
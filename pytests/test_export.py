@@ -0,0 +1,27 @@
+import torch
+import torchKQI
+import math
+import tempfile
+import pathlib
+from torchKQI import cache
+
+
+def test_export_graph(tmp_path):
+    model, x = torch.nn.Sequential(torch.nn.Conv2d(3, 4, kernel_size=3, padding=1), torch.nn.ReLU(), torch.nn.Flatten(), torch.nn.Linear(4 * 4 * 4, 5)), torch.randn(1, 3, 4, 4)
+    nodes = {v: (pred, name, kqi, volume) for v, pred, name, kqi, volume in torchKQI.Graph(model, x)}
+    # A shard size below the number of nodes and edges splits both into several shards.
+    index = torchKQI.export_graph(model, x, str(tmp_path), shard_size=100)
+    graph = torchKQI.load_graph(str(tmp_path))
+    assert (tmp_path / 'index.json').stat().st_mode & 0o777 == cache.FILE_MODE
+    assert graph['ops'] == index['ops'] and len(graph['nodes']) > 1 and len(graph['edges']) > 1
+    assert sum(len(shard['id']) for shard in graph['nodes']) == len(nodes)
+    assert math.isclose(sum(shard['kqi'].sum() for shard in graph['nodes']), sum(kqi for _, _, kqi, _ in nodes.values()), rel_tol=1e-6)
+    for shard in graph['nodes']:
+        for v, op, kqi, volume in zip(shard['id'], shard['op'], shard['kqi'], shard['volume']):
+            assert graph['ops'][op] == nodes[v][1] and math.isclose(kqi, nodes[v][2], rel_tol=1e-6, abs_tol=1e-12) and volume == nodes[v][3]
+    edges = sorted((int(src), int(dst)) for shard in graph['edges'] for src, dst in zip(shard['src'], shard['dst']))
+    assert edges == sorted((src, v) for v, (pred, _, _, _) in nodes.items() for src in pred)
+
+
+if __name__ == '__main__':
+    test_export_graph(pathlib.Path(tempfile.mkdtemp()))
@@ -40,6 +40,44 @@ def test_Unfold():
     testtool.testKQI(TestUnfold(), torch.randn(1, 8 * 8))
 
 
+def test_FoldOverlap():
+    class TestFoldOverlap(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.linear1 = torch.nn.Linear(in_features=16, out_features=36, bias=False)
+            self.unfold = torch.nn.Unfold(kernel_size=(3, 3))
+            self.fold = torch.nn.Fold(output_size=(4, 4), kernel_size=(3, 3), padding=1)
+
+        def forward(self, x):
+            x = self.linear1(x)
+            x = x.view(1, 1, 6, 6)
+            x = self.unfold(x)
+            x = self.fold(x)
+
+            return x
+
+    testtool.testKQI(TestFoldOverlap(), torch.randn(1, 4 * 4))
+
+
+def test_UnfoldPadding():
+    class TestUnfoldPadding(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.linear1 = torch.nn.Linear(in_features=48, out_features=48, bias=False)
+            self.unfold = torch.nn.Unfold(kernel_size=(2, 3), dilation=(1, 2), padding=(1, 0))
+
+        def forward(self, x):
+            x = self.linear1(x)
+            x = x.view(1, 2, 4, 6)
+            x = self.unfold(x)
+
+            return x
+
+    testtool.testKQI(TestUnfoldPadding(), torch.randn(1, 48))
+
+
 if __name__ == '__main__':
     test_Fold()
     test_Unfold()
+    test_FoldOverlap()
+    test_UnfoldPadding()
@@ -0,0 +1,108 @@
+import torch
+import torchKQI
+import math
+import logging
+import concurrent.futures
+from torchKQI import kqi, function_base
+
+
+def test_fast():
+    model, x = torch.nn.Sequential(torch.nn.Linear(8, 6), torch.nn.Tanh(), torch.nn.Linear(6, 3)), torch.randn(2, 8)
+    signatures = function_base.Context.signatures
+    signatures.clear()
+    kqi = torchKQI.KQI(model, x)
+    assert len(signatures) == 0
+    assert math.isclose(torchKQI.KQI(model, x, fast=True), kqi, rel_tol=1e-6)
+    seen = len(signatures)
+    assert seen > 0
+    # Each signature is validated once, and later runs of the same shapes skip the checks.
+    assert math.isclose(torchKQI.KQI(model, x, fast=True), kqi, rel_tol=1e-6)
+    assert len(signatures) == seen
+
+    max_signatures, function_base.Context.max_signatures = function_base.Context.max_signatures, 4
+    try:
+        torchKQI.KQI(model, torch.randn(3, 8), fast=True)
+        assert len(signatures) == 4
+    finally:
+        function_base.Context.max_signatures = max_signatures
+
+
+def test_observability():
+    model, x = torch.nn.Sequential(torch.nn.Linear(8, 6), torch.nn.ReLU(), torch.nn.Linear(6, 3)), torch.randn(2, 8)
+    steps, events = [], []
+    torchKQI.KQI(model, x, progress=lambda done, total: steps.append((done, total)), events=events.append)
+    total = events[0]['total']
+    assert events[0]['event'] == 'start' and events[-1]['event'] == 'finish'
+    assert steps == [(done, total) for done in range(1, total + 1)]
+    cells = [event for event in events if event['event'] == 'cell']
+    assert len(cells) == total and {event['phase'] for event in cells} == {'Volume', 'KQI'}
+    assert all(not logging.getLogger(name).handlers for name in ('torchKQI', 'torchKQI.kqi', 'torchKQI.function_base'))
+
+
+def test_structure_cache():
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, kernel_size=3, padding=1), torch.nn.ReLU(), torch.nn.Conv2d(4, 4, kernel_size=3, padding=1))
+    x = torch.randn(1, 3, 8, 8)
+    torchKQI.structure_cache.clear()
+    kqi = torchKQI.KQI(model, x)
+    hits, misses = torchKQI.structure_cache.hits, torchKQI.structure_cache.misses
+    assert misses > 0
+    # A second run of the same shapes finds every structure in the cache.
+    assert math.isclose(torchKQI.KQI(model, x), kqi, rel_tol=1e-6)
+    assert torchKQI.structure_cache.misses == misses and torchKQI.structure_cache.hits == 2 * hits + misses
+
+
+def test_memory_budget():
+    model, x = torch.nn.Sequential(torch.nn.Linear(16, 32), torch.nn.Tanh(), torch.nn.Linear(32, 10), torch.nn.Softmax(-1)), torch.randn(4, 16)
+    # The outputs of both linear layers and of the softmax exceed the budget, so their cells run in chunks.
+    assert 4 * 10 * 4 * function_base.FuncBase.tiling_temporaries > 256
+    kqi = torchKQI.KQI(model, x)
+    assert math.isclose(torchKQI.KQI(model, x, memory_budget=256), kqi, rel_tol=1e-6)
+    for (grad_fn, ks), (_, tiled) in zip(torchKQI.KQI_generator(model, x), torchKQI.KQI_generator(model, x, memory_budget=256)):
+        assert all(torch.allclose(k, t, rtol=1e-4, atol=1e-6) for k, t in zip(ks, tiled)), grad_fn.name()
+
+
+def test_concurrent_sessions():
+    models = [torch.nn.Sequential(torch.nn.Linear(8, 6), torch.nn.Tanh(), torch.nn.Linear(6, 3)) for _ in range(4)]
+    x = torch.randn(2, 8)
+    kqis = [torchKQI.KQI(model, x) for model in models]
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        assert all(math.isclose(k, kqi, rel_tol=1e-6) for k, kqi in zip(executor.map(lambda model: torchKQI.KQI(model, x), models), kqis))
+
+    # Runs on one model are traced one at a time, and then proceed at once.
+    breakdown = torchKQI.KQI_breakdown(models[0], x)
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda i: torchKQI.KQI_breakdown(models[0], x) if i % 2 else torchKQI.KQI(models[0], x), range(64)))
+    assert all(math.isclose(result, kqis[0], rel_tol=1e-6) for result in results[::2])
+    assert all(result['parameters'] == breakdown['parameters'] for result in results[1::2])
+
+    # Interleaved generators each keep their own session.
+    expected = [[ks for _, ks in torchKQI.KQI_generator(model, x)] for model in models[:2]]
+    for (_, ks0), (_, ks1), e0, e1 in zip(torchKQI.KQI_generator(models[0], x), torchKQI.KQI_generator(models[1], x), *expected):
+        assert all(torch.allclose(k, e) for k, e in zip(ks0 + ks1, e0 + e1))
+
+
+def test_snapshot():
+    model, x = torch.nn.Conv2d(3, 4, kernel_size=3, stride=2), torch.randn(1, 3, 8, 8)
+
+    @function_base.isolated
+    def snapshot():
+        return function_base.GradFn.of(kqi.__prepare(model, x, lambda model, x: model(x), torch.device('cpu')).grad_fn)
+
+    # Every _saved_ attribute is read when the snapshot is taken, and the snapshot cannot change afterwards.
+    grad_fn = snapshot()
+    assert grad_fn.attrs['_saved_stride'] == (2, 2) and grad_fn.__getattribute__('_saved_padding') == (0, 0)
+    try:
+        grad_fn.attrs['_saved_stride'] = (1, 1)
+        assert False
+    except TypeError:
+        pass
+    assert grad_fn.attrs['_saved_stride'] == (2, 2)
+
+
+if __name__ == '__main__':
+    test_fast()
+    test_observability()
+    test_structure_cache()
+    test_memory_budget()
+    test_concurrent_sessions()
+    test_snapshot()
@@ -0,0 +1,31 @@
+import torch
+import torchKQI
+import asyncio
+import tempfile
+import pathlib
+
+
+def test_generator_async(tmp_path):
+    model, x = torch.nn.Sequential(torch.nn.Linear(8, 6), torch.nn.Tanh(), torch.nn.Linear(6, 3)), torch.randn(2, 8)
+    expected = [ks for _, ks in torchKQI.KQI_generator(model, x)]
+
+    async def consume(limit=None, **kwargs):
+        results, steps = [], []
+        async for _, ks in torchKQI.KQI_generator_async(model, x, progress=lambda done, total: steps.append(done), **kwargs):
+            results.append(ks)
+            if len(results) == limit:
+                break
+        await asyncio.sleep(0)
+        return results, steps
+
+    results, steps = asyncio.run(consume(maxsize=1))
+    assert len(results) == len(expected) and all(torch.equal(k, e) for ks, es in zip(results, expected) for k, e in zip(ks, es))
+    assert steps == list(range(1, len(steps) + 1))
+
+    # Leaving the loop early stops the traversal and removes the volumes it spilled to disk.
+    results, _ = asyncio.run(consume(limit=2, maxsize=1, disk_cache_dir=str(tmp_path / 'cache')))
+    assert len(results) == 2 and not (tmp_path / 'cache' / 'volumes').exists()
+
+
+if __name__ == '__main__':
+    test_generator_async(pathlib.Path(tempfile.mkdtemp()))
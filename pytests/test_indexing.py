@@ -0,0 +1,24 @@
+import torch
+import testtool
+
+
+def test_Index():
+    class TestIndex(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.linear1 = torch.nn.Linear(in_features=4, out_features=12, bias=False)
+            self.unfold = torch.nn.Unfold(kernel_size=(2, 2))
+
+        def forward(self, x):
+            x = self.linear1(x)
+            x = self.unfold(x.view(1, 1, 3, 4)).squeeze(0).t()
+            x = x[torch.tensor([0, 2, 2, -1, 3])]
+            x = x[x.new_tensor([True, False, True, True, True], dtype=torch.bool)]
+
+            return x
+
+    testtool.testKQI(TestIndex(), torch.randn(1, 4))
+
+
+if __name__ == '__main__':
+    test_Index()
@@ -438,6 +438,45 @@ def test_MaxUnpool3d():
     testtool.testKQI(TestMaxUnpool3d(), torch.randn(1, 10, 10, 10))
 
 
+def test_AvgPool2d_output():
+    class TestAvgPool2dOutput(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.layers = torch.nn.Sequential(
+                # 1x4x4
+                torch.nn.Linear(in_features=4, out_features=4, bias=False),
+                # 1x4x4
+                torch.nn.AvgPool2d(kernel_size=3, stride=1, padding=1)
+            )
+
+        def forward(self, x):
+            return self.layers(x)
+
+    testtool.testKQI(TestAvgPool2dOutput(), torch.randn(1, 4, 4))
+
+
+def test_AvgPool2d_slice():
+    class TestAvgPool2dSlice(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.layers1 = torch.nn.Sequential(
+                # 1x4x4
+                torch.nn.Linear(in_features=4, out_features=4, bias=False),
+                # 1x4x4
+                torch.nn.AvgPool2d(kernel_size=3, stride=1, padding=1)
+            )
+            # 1x2x2
+            self.layers2 = torch.nn.Linear(in_features=2, out_features=3, bias=False)
+
+        def forward(self, x):
+            x = self.layers1(x)
+            x = x[..., :2, :2]
+            x = self.layers2(x)
+            return x
+
+    testtool.testKQI(TestAvgPool2dSlice(), torch.randn(1, 4, 4))
+
+
 if __name__ == '__main__':
     test_AvgPool1d()
     test_AvgPool2d()
@@ -458,3 +497,5 @@ if __name__ == '__main__':
     test_MaxUnpool1d()
     test_MaxUnpool2d()
     test_MaxUnpool3d()
+    test_AvgPool2d_output()
+    test_AvgPool2d_slice()
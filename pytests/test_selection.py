@@ -0,0 +1,36 @@
+import torch
+import torchKQI
+
+
+def test_topk():
+    model, x = torch.nn.Sequential(torch.nn.Linear(16, 12), torch.nn.Tanh(), torch.nn.Linear(12, 4)), torch.randn(2, 16)
+    names = {var: name for name, var in model.named_parameters()}
+    kqis = {names[grad_fn.variable]: ks[0] for grad_fn, ks in torchKQI.KQI_generator(model, x) if 'AccumulateGrad' in grad_fn.name()}
+    flat = torch.cat([kqi.flatten() for kqi in kqis.values()])
+    # k = 100 and 77 are below the number of elements, and trigger the pruning of candidates during the traversal.
+    for k, largest in [(0, True), (77, False), (100, True), (flat.numel() + 1, True)]:
+        masks, values = torchKQI.topk(model, x, k, largest=largest, return_values=True)
+        assert masks.keys() == kqis.keys() and all(masks[name].shape == kqi.shape for name, kqi in kqis.items())
+        assert all(torch.equal(values[name], kqis[name][mask]) for name, mask in masks.items())
+        expected = flat.topk(min(k, flat.numel()), largest=largest).values
+        assert torch.equal(torch.cat(list(values.values())).sort().values, expected.sort().values)
+        assert all(torch.equal(torchKQI.topk(model, x, k, largest=largest)[name], mask) for name, mask in masks.items())
+
+    masks = torchKQI.topk(model, x, 50, params_only=False)
+    assert sum(int(mask.sum()) for mask in masks.values()) == 50 and len(masks) > len(kqis)
+
+
+def test_threshold():
+    model, x = torch.nn.Sequential(torch.nn.Linear(16, 12), torch.nn.Tanh(), torch.nn.Linear(12, 4)), torch.randn(2, 16)
+    names = {var: name for name, var in model.named_parameters()}
+    kqis = {names[grad_fn.variable]: ks[0] for grad_fn, ks in torchKQI.KQI_generator(model, x) if 'AccumulateGrad' in grad_fn.name()}
+    value = torch.cat([kqi.flatten() for kqi in kqis.values()]).median()
+    masks = torchKQI.threshold(model, x, value)
+    assert all(torch.equal(masks[name], kqi >= value) for name, kqi in kqis.items())
+    masks = torchKQI.threshold(model, x, value, above=False)
+    assert all(torch.equal(masks[name], kqi <= value) for name, kqi in kqis.items())
+
+
+if __name__ == '__main__':
+    test_topk()
+    test_threshold()
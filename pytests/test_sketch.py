@@ -0,0 +1,52 @@
+import torch
+import torchKQI
+import math
+import json
+from torchKQI.sketch import LogHistogram
+
+
+def test_quantiles():
+    histogram = LogHistogram(bins_per_octave=8)
+    values = torch.rand(10000, dtype=torch.float64).mul_(20).sub_(10).exp2_()  # From 2 ** -10 to 2 ** 10
+    for chunk in values.split(999):
+        histogram.add(chunk)
+    assert histogram.count == values.numel() and math.isclose(histogram.sum, values.sum(), rel_tol=1e-9)
+    assert histogram.min == values.min() and histogram.max == values.max()
+    ordered = values.sort().values
+    for q in (0, 0.01, 0.25, 0.5, 0.9, 0.99, 1):
+        # Within a bin, i.e. a factor 2 ** (1 / 8), of the exact quantile.
+        assert abs(math.log2(histogram.quantile(q) / ordered[int(q * (len(values) - 1))])) <= 1 / 8
+    assert histogram.min <= histogram.quantile(0) <= histogram.quantile(0.5) <= histogram.quantile(1) <= histogram.max
+
+
+def test_nonpositive():
+    histogram = LogHistogram()
+    histogram.add(torch.tensor([0.0, -1.0, 0.0, 1.0, 2.0, 4.0]))
+    assert histogram.nonpositive == 3 and int(histogram.counts.sum()) == 3 and histogram.counts[0] == 0
+    assert histogram.quantile(0) == histogram.quantile(0.4) == 0.0 and histogram.quantile(1) == 4.0
+    assert abs(math.log2(histogram.quantile(0.6))) <= 1 / 8
+    merged = LogHistogram.from_dict(json.loads(json.dumps(histogram.to_dict()))).merge(histogram)
+    assert merged.nonpositive == 6 and merged.count == 12 and merged.quantile(0.4) == 0.0
+
+
+def test_sketch():
+    model, x = torch.nn.Sequential(torch.nn.Linear(16, 12), torch.nn.Tanh(), torch.nn.Linear(12, 4)), torch.randn(2, 16)
+    results = [(grad_fn, ks) for grad_fn, ks in torchKQI.KQI_generator(model, x)]
+    sketch = torchKQI.KQISketch().consume(results, model)
+    assert set(sketch.parameters) == {name for name, _ in model.named_parameters()}
+    kqi = torch.cat([k.flatten() for _, ks in results for k in ks]).double()
+    assert sum(h.count for h in sketch.ops.values()) == kqi.numel()
+    assert math.isclose(sum(h.sum for h in sketch.ops.values()), kqi.sum(), rel_tol=1e-9)
+
+    # Sketches of two halves of a run, one of them through JSON, merge into that of the whole run.
+    half = len(results) // 2
+    merged = torchKQI.KQISketch().consume(results[:half], model).merge(torchKQI.KQISketch.from_dict(json.loads(json.dumps(torchKQI.KQISketch().consume(results[half:], model).to_dict()))))
+    for key, histogram in sketch.ops.items():
+        assert torch.equal(merged.ops[key].counts, histogram.counts) and merged.ops[key].nonpositive == histogram.nonpositive
+        assert merged.ops[key].summary() == histogram.summary() or math.isclose(merged.ops[key].sum, histogram.sum, rel_tol=1e-9)
+
+
+if __name__ == '__main__':
+    test_quantiles()
+    test_nonpositive()
+    test_sketch()
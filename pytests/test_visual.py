@@ -0,0 +1,15 @@
+import torch
+import torchKQI
+import tempfile
+import pathlib
+
+
+def test_visual_positional(tmp_path):
+    model, x = torch.nn.Sequential(torch.nn.Linear(8, 6), torch.nn.Tanh(), torch.nn.Linear(6, 3)), torch.randn(2, 8)
+    # filename stays the sixth positional parameter; newer options come after fontsize.
+    torchKQI.VisualKQI(model, x, lambda model, x: model(x), torch.device('cpu'), None, str(tmp_path / 'kqi.png'))
+    assert (tmp_path / 'kqi.png').exists()
+
+
+if __name__ == '__main__':
+    test_visual_positional(pathlib.Path(tempfile.mkdtemp()))
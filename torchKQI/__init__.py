@@ -1,6 +1,13 @@
-from .kqi import KQI, Graph, KQI_generator, VisualKQI
+from .kqi import KQI, KQI_breakdown, Graph, export_graph, KQI_generator, KQI_generator_async, topk, threshold, VisualKQI
+from .export import load_graph
+from .sketch import KQISketch
+from .function_base import ProgressBar
+from . import function_base
+
+
+structure_cache = function_base.Context.structures
 
 
 __all__ = [
-    'KQI', 'Graph', 'KQI_generator', 'VisualKQI'
+    'KQI', 'KQI_breakdown', 'Graph', 'export_graph', 'load_graph', 'KQI_generator', 'KQI_generator_async', 'topk', 'threshold', 'VisualKQI', 'KQISketch', 'ProgressBar', 'structure_cache'
 ]
@@ -0,0 +1,101 @@
+import torch
+import hashlib
+import json
+import os
+import tempfile
+from . import functions, function_base
+from typing import Dict
+
+
+# Bump whenever a change to the cells alters KQI values, or the stored results change shape, so that stored results are not reused.
+FORMAT = 3
+
+# mkstemp creates files 0600, so files written through it are given the mode open() would give them.
+# The umask is read once, since reading it means setting it.
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
+
+def canonical(value, contents: bool = False):
+    if isinstance(value, torch.Tensor):
+        if contents:
+            return ('tensor', tuple(value.shape), str(value.dtype), hashlib.sha256(value.detach().cpu().contiguous().numpy().tobytes()).hexdigest())
+        return ('tensor', tuple(value.shape), str(value.dtype))
+    if isinstance(value, (tuple, list)):
+        return tuple(canonical(v, contents) for v in value)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+def signature(grad_fn) -> str:
+    '''
+    Canonical hash of the autograd graph rooted at grad_fn: op names, edges, tensor shapes, _saved_ hyperparameters and module paths.
+    Activation values are left out because no cell reads them, so checkpoints of the same architecture share a signature.
+    Must be called after the hooks have filled Context.grad_fn_info.
+    '''
+    index = {grad_fn: 0}
+    stack = [grad_fn]
+    nodes = []
+    while stack:
+        cur = stack.pop()
+        func = functions.backward_mapper(cur)
+        edges = []
+        for next_fn, i in cur.next_functions:
+            if next_fn is not None and next_fn not in index:
+                index[next_fn] = len(index)
+                stack.append(next_fn)
+            edges.append((index[next_fn], i) if next_fn is not None else None)
+        attrs = []
+        for attr in sorted(dir(cur)):
+            if '_saved' in attr and '_raw' not in attr:
+                try:
+                    attrs.append((attr, canonical(getattr(cur, attr), attr in func.saved_values)))
+                except RuntimeError:
+                    attrs.append((attr, None))
+        info = function_base.Context.grad_fn_info[cur]
+        nodes.append((index[cur], cur.name(), canonical(info['input']), canonical(info['output']), tuple(edges), tuple(attrs), function_base.Context.modules.get(cur)))
+    return hashlib.sha256(repr((FORMAT, str(torch.get_default_dtype()), nodes)).encode()).hexdigest()
+
+
+class ResultCache:
+    '''
+    Content-addressed store of KQI results, one JSON file per signature plus an optional tensor file.
+    Files are written to a temporary name and renamed, so a result is either complete or absent.
+    '''
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _get_file_path(self, key, suffix):
+        return os.path.join(self.cache_dir, f'{key}.{suffix}')
+
+    def __contains__(self, key):
+        return os.path.exists(self._get_file_path(key, 'json'))
+
+    def load(self, key) -> dict:
+        if key not in self:
+            return None
+        with open(self._get_file_path(key, 'json'), 'r') as file:
+            return json.load(file)
+
+    def load_tensors(self, key) -> Dict[str, torch.Tensor]:
+        file_path = self._get_file_path(key, 'pt')
+        if key not in self or not os.path.exists(file_path):
+            return None
+        return torch.load(file_path)
+
+    def store(self, key, result: dict, tensors: Dict[str, torch.Tensor] = None):
+        if tensors is not None:
+            self._replace(self._get_file_path(key, 'pt'), lambda file: torch.save(tensors, file))
+        self._replace(self._get_file_path(key, 'json'), lambda file: file.write(json.dumps(result).encode()))
+
+    @staticmethod
+    def _replace(file_path, write):
+        # A unique temporary name per write, as threads of one process may store the same key at once.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=os.path.basename(file_path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+        os.chmod(tmp_path, FILE_MODE)
+        os.replace(tmp_path, file_path)
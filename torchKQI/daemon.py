@@ -0,0 +1,210 @@
+import argparse
+import concurrent.futures
+import hmac
+import importlib
+import json
+import os
+import secrets
+import threading
+import time
+import urllib.request
+import uuid
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict
+from . import cache, kqi
+
+
+def load_registry(name: str) -> Dict[str, Callable]:
+    '''
+    Loaders of a registry given as package.module:attribute, a dict of task -> function returning {model name: loader} like TASKS
+    of example/evaluate.py. Each loader returns (model, x, callback_func), and is named '{task}/{model name}'.
+    '''
+    module, _, attribute = name.partition(':')
+    tasks = getattr(importlib.import_module(module), attribute)
+    return {f'{task}/{model_name}': load for task, models in tasks.items() for model_name, load in models().items()}
+
+
+class Daemon:
+    '''
+    Job queue in front of KQI_breakdown, with a worker pool, an LRU of traced graphs and a persistent result store.
+    Only the models of loaders, a dict of name -> function returning (model, x, callback_func), are served.
+    Results are stored under the graph signature, so they follow whatever a loader builds and are shared by every model of the same architecture.
+    A model is traced once to learn its signature; after that its queries are answered from the store without touching it.
+    '''
+    def __init__(self, store_dir: str, loaders: Dict[str, Callable], token: str = None, workers: int = 2, max_models: int = 8, max_jobs: int = 1024):
+        self.store_dir = store_dir
+        self.loaders = loaders
+        self.token = token if token is not None else secrets.token_urlsafe(32)
+        self.results = cache.ResultCache(store_dir)
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self.max_models, self.max_jobs = max_models, max_jobs
+        self.models = OrderedDict()  # model name -> (model, prepared graph, lock)
+        self.signatures = {}  # model name -> graph signature
+        self.jobs = OrderedDict()  # job id -> {'spec', 'future', 'submitted'}
+        self.lock = threading.Lock()
+
+    def submit(self, spec: dict) -> str:
+        if spec.get('model') not in self.loaders:
+            raise KeyError(f'Unknown model {spec.get("model")}')
+        job = str(uuid.uuid4())
+        future = concurrent.futures.Future()
+        with self.lock:
+            key = self.signatures.get(spec['model'])
+        result = self.results.load(key) if key is not None else None
+        if result is not None:
+            future.set_result(dict(result, cached=True))
+        else:
+            future = self.pool.submit(self.run, spec)
+        with self.lock:
+            self.jobs[job] = {'spec': spec, 'future': future, 'submitted': time.time()}
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        return job
+
+    def run(self, spec: dict) -> dict:
+        model, prepared, lock = self.model(spec['model'])
+        with lock:  # A prepared graph is computed on by one run at a time, as the runs share its session
+            cached = prepared[2] in self.results
+            result = kqi.prepared_breakdown(model, prepared, cache_dir=self.store_dir)
+        return dict(result, cached=cached)
+
+    def model(self, name: str):
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name]
+        model, x, callback_func = self.loaders[name]()
+        entry = (model, kqi.prepare(model, x, callback_func), threading.Lock())
+        with self.lock:
+            entry = self.models.setdefault(name, entry)
+            self.signatures[name] = entry[1][2]
+            while len(self.models) > self.max_models:
+                self.models.popitem(last=False)
+        return entry
+
+    def status(self, job: str, wait: bool = False) -> dict:
+        with self.lock:
+            if job not in self.jobs:
+                return None
+            future = self.jobs[job]['future']
+        if wait:
+            concurrent.futures.wait([future])
+        if not future.done():
+            return {'id': job, 'state': 'running' if future.running() else 'queued'}
+        if future.exception() is not None:
+            return {'id': job, 'state': 'error', 'error': repr(future.exception())}
+        return {'id': job, 'state': 'done', 'result': future.result()}
+
+    def stats(self) -> dict:
+        with self.lock:
+            futures = [job['future'] for job in self.jobs.values()]
+            models = len(self.models)
+        return {'jobs': len(futures), 'pending': sum(not future.done() for future in futures), 'models': models}
+
+    def serve(self, host: str = '127.0.0.1', port: int = 8765) -> ThreadingHTTPServer:
+        '''
+        HTTP server on host:port: POST /jobs and POST /query take a query, GET /jobs/<id>[?wait], GET /models and GET /stats report.
+        Requests carry 'Authorization: Bearer <token>', and POST bodies are 'application/json', which browsers do not send cross-site
+        without a preflight. Call serve_forever on the result, or shutdown to stop it.
+        '''
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, code, body):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def authorized(self):
+                if hmac.compare_digest(self.headers.get('Authorization', '').encode(), f'Bearer {daemon.token}'.encode()):
+                    return True
+                self.reply(401, {'error': 'Missing or wrong token'})
+                return False
+
+            def do_POST(self):
+                if not self.authorized():
+                    return
+                if self.path not in ('/jobs', '/query'):
+                    return self.reply(404, {'error': f'Unknown path {self.path}'})
+                if self.headers.get_content_type() != 'application/json':
+                    return self.reply(415, {'error': 'Content-Type must be application/json'})
+                try:
+                    job = daemon.submit(json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0)))))
+                except Exception as err:
+                    return self.reply(400, {'error': repr(err)})
+                if self.path == '/jobs':
+                    return self.reply(202, {'id': job})
+                self.reply(200, daemon.status(job, wait=True))
+
+            def do_GET(self):
+                if not self.authorized():
+                    return
+                path, _, query = self.path.partition('?')
+                if path == '/stats':
+                    return self.reply(200, daemon.stats())
+                if path == '/models':
+                    return self.reply(200, sorted(daemon.loaders))
+                if path.startswith('/jobs/'):
+                    status = daemon.status(path[len('/jobs/'):], wait=query == 'wait')
+                    return self.reply(200, status) if status is not None else self.reply(404, {'error': 'Unknown job'})
+                self.reply(404, {'error': f'Unknown path {self.path}'})
+
+            def log_message(self, format, *args):
+                pass
+
+        return ThreadingHTTPServer((host, port), Handler)
+
+
+def request(address: str, token: str, path: str, body: dict = None) -> dict:
+    data = json.dumps(body).encode() if body is not None else None
+    http_request = urllib.request.Request(f'http://{address}{path}', data=data, headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {token}'})
+    try:
+        with urllib.request.urlopen(http_request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as err:
+        return json.loads(err.read())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m torchKQI.daemon', description='Local KQI job daemon and its client.')
+    parser.add_argument('--address', type=str, default='127.0.0.1:8765', help='host:port of the daemon.')
+    parser.add_argument('--token-file', type=str, default=os.path.expanduser('~/.torchKQI/daemon.token'), help='File holding the token, written by serve and read by the client.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='Run the daemon.')
+    serve.add_argument('registry', type=str, help='Models to serve, as package.module:attribute of a dict like TASKS of example/evaluate.py.')
+    serve.add_argument('--store', type=str, default='kqi_store', help='Directory of the persistent result store.')
+    serve.add_argument('--workers', type=int, default=2, help='Number of KQI runs at once.')
+    serve.add_argument('--models', type=int, default=8, help='Number of traced models kept warm.')
+    query = commands.add_parser('query', help='Compute the KQI breakdown of a model.')
+    query.add_argument('model', type=str, help='Model name, as task/model name.')
+    query.add_argument('--no-wait', action='store_true', help='Print the job id instead of waiting for the result.')
+    status = commands.add_parser('status', help='Report a job, or the daemon without one.')
+    status.add_argument('job', type=str, nargs='?', default=None)
+    commands.add_parser('models', help='List the models served.')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        daemon = Daemon(args.store, load_registry(args.registry), workers=args.workers, max_models=args.models)
+        os.makedirs(os.path.dirname(args.token_file), exist_ok=True)
+        with open(os.open(args.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+            file.write(daemon.token)
+        host, _, port = args.address.rpartition(':')
+        daemon.serve(host, int(port)).serve_forever()
+        return
+
+    with open(args.token_file) as file:
+        token = file.read().strip()
+    if args.command == 'query':
+        print(json.dumps(request(args.address, token, '/jobs' if args.no_wait else '/query', {'model': args.model}), indent=2))
+    elif args.command == 'models':
+        print(json.dumps(request(args.address, token, '/models'), indent=2))
+    else:
+        print(json.dumps(request(args.address, token, f'/jobs/{args.job}' if args.job else '/stats'), indent=2))
+
+
+if __name__ == '__main__':
+    main()
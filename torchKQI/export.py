@@ -0,0 +1,85 @@
+import numpy as np
+import itertools
+import json
+import os
+import tempfile
+from . import cache
+
+
+# Columns of the two tables of an exported element graph.
+COLUMNS = {'nodes': {'id': np.int64, 'op': np.int32, 'kqi': np.float64, 'volume': np.float64},
+           'edges': {'src': np.int64, 'dst': np.int64}}
+
+
+class Shards:
+    '''
+    Rows of one table, buffered column by column and saved as '{table}-{index}.{column}.npy' once shard_size rows are complete.
+    '''
+    def __init__(self, path: str, table: str, shard_size: int):
+        self.path, self.table, self.shard_size = path, table, shard_size
+        self.buffers = {column: [] for column in COLUMNS[table]}
+        self.rows = 0
+        self.files = []
+
+    def append(self, **columns):
+        arrays = [np.asarray(columns[column], dtype=dtype) for column, dtype in COLUMNS[self.table].items()]
+        for buffer, array in zip(self.buffers.values(), arrays):
+            buffer.append(array)
+        self.rows += len(arrays[0])
+        while self.rows >= self.shard_size:
+            self.flush(self.shard_size)
+
+    def flush(self, rows: int = None):
+        rows = self.rows if rows is None else rows
+        if rows == 0:
+            return
+        name = f'{self.table}-{len(self.files):05d}'
+        for column, buffer in self.buffers.items():
+            data = np.concatenate(buffer)
+            np.save(os.path.join(self.path, f'{name}.{column}.npy'), data[:rows])
+            self.buffers[column] = [data[rows:]]
+        self.rows -= rows
+        self.files.append(name)
+
+
+class GraphWriter:
+    '''
+    Streams the element graph of torchKQI.Graph to a directory of NPY shards, so memory is bounded by the shard size rather than by the graph.
+    Edges run from a node to its successor (src feeds dst). index.json is written last, so a directory without it is incomplete.
+    '''
+    def __init__(self, path: str, shard_size: int = 1 << 20):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.ops = {}
+        self.tables = {table: Shards(path, table, shard_size) for table in COLUMNS}
+
+    def add(self, op: str, node_ids, kqis, volumes, adj):
+        op = self.ops.setdefault(op, len(self.ops))
+        for node_id, kqi, volume in zip(node_ids, kqis, volumes):
+            ids = node_id.flatten().long().tolist()
+            self.tables['nodes'].append(id=ids, op=np.full(len(ids), op), kqi=kqi.flatten().double().numpy(), volume=volume.flatten().double().numpy())
+            preds = [adj[i] for i in ids]
+            self.tables['edges'].append(src=np.fromiter(itertools.chain.from_iterable(preds), dtype=np.int64), dst=np.repeat(ids, [len(pred) for pred in preds]))
+
+    def close(self, **meta) -> dict:
+        for shards in self.tables.values():
+            shards.flush()
+        index = dict(meta, ops=list(self.ops), **{table: shards.files for table, shards in self.tables.items()})
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='index.json', suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(index, file)
+        os.chmod(tmp_path, cache.FILE_MODE)
+        os.replace(tmp_path, os.path.join(self.path, 'index.json'))
+        return index
+
+
+def load_graph(path: str) -> dict:
+    '''
+    Open a graph written by torchKQI.export_graph without reading it into memory.
+    Returns the index with 'nodes' and 'edges' replaced by lists of shards, each a dict of memory-mapped columns.
+    '''
+    with open(os.path.join(path, 'index.json')) as file:
+        index = json.load(file)
+    for table, columns in COLUMNS.items():
+        index[table] = [{column: np.load(os.path.join(path, f'{name}.{column}.npy'), mmap_mode='r') for column in columns} for name in index[table]]
+    return index
@@ -3,12 +3,24 @@ import torch
 import logging
 import tqdm
 import ctypes
-from typing import Tuple, Dict
+from typing import Tuple, Dict, Iterator, Mapping
+from types import MappingProxyType
 from functools import wraps
+from dataclasses import dataclass, field
+from collections import OrderedDict
 import itertools
+import math
 import os
 import pickle
 import shutil
+import time
+import contextvars
+import inspect
+import threading
+import weakref
+
+
+logger = logging.getLogger(__name__)
 
 
 class DiskDict:
@@ -27,12 +39,12 @@ class DiskDict:
             raise KeyError(f"Key {key} not found.")
         file_path = self._get_file_path(key)
         with open(file_path, 'rb') as file:
-            return pickle.load(file)
+            return Context.to_device(pickle.load(file), Context.device[0])
 
     def __setitem__(self, key, value):
         file_path = self._get_file_path(key)
         with open(file_path, 'wb') as file:
-            pickle.dump(value, file)
+            pickle.dump(Context.to_host(value), file)
         self._keys.add(key)
 
     def __delitem__(self, key):
@@ -60,24 +72,168 @@ class DiskDict:
             yield key, self[key]
 
 
-class Context:
-    bar = None
-    device = [torch.device('cpu')]
-    grad_fn_info = {}
-    pool = None
+class ProgressBar:
+    def __init__(self, desc: str = None):
+        self.desc = desc
+        self.bar = None
+
+    def __call__(self, done: int, total: int):
+        if self.bar is None:
+            self.bar = tqdm.tqdm(desc=self.desc, total=total)
+        self.bar.update(done - self.bar.n)
+
+
+class StructureCache:
+    '''
+    LRU cache for tensors that depend only on shapes and op hyperparameters, such as degree tensors.
+    Cached tensors are shared between nodes and between concurrent runs, so callers must treat them as read-only.
+    '''
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def signature(arg):
+        if isinstance(arg, torch.Tensor):
+            return ('tensor', tuple(arg.shape))
+        if isinstance(arg, (tuple, list)):
+            return tuple(StructureCache.signature(a) for a in arg)
+        return arg
+
+    def get(self, key, factory):
+        with self._lock:
+            if key in self._store:
+                self.hits += 1
+                self._store.move_to_end(key)
+                return self._store[key]
+            self.misses += 1
+        value = factory()
+        with self._lock:
+            value = self._store.setdefault(key, value)
+            if len(self._store) > self.maxsize:
+                self._store.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._store), 'maxsize': self.maxsize}
+
+
+class Session:
+    '''
+    State of one KQI run. Each call of an entry point runs in a session of its own (see isolated),
+    so runs in other threads and interleaved generators do not see each other's state.
+    '''
+    def __init__(self):
+        self.device = [torch.device('cpu')]
+        self.host = True
+        self.grad_fn_info = {}
+        self.snapshots = {}
+        self.modules = {}  # Dict[grad_fn, module path]
+        self.pool = None
+        self.fast = False
+        self.progress = None  # Callable[[int, int], None]
+        self.memory_budget = None  # bytes
+        self.events = None  # Callable[[dict], None]
+        self.done = 0
+        self.total = 0
+        self.W = torch.tensor(0, dtype=float)
+
+
+session = contextvars.ContextVar('session', default=Session())
+
+
+def isolated(func):
+    '''
+    Run every call of func in a new Session. A generator is resumed inside its session at each step, so generators can be interleaved.
+    '''
+    if inspect.isgeneratorfunction(func):
+        @wraps(func)
+        def wrapped_generator(*args, **kwargs):
+            context = contextvars.copy_context()
+            context.run(session.set, Session())
+            generator = context.run(func, *args, **kwargs)
+            try:
+                while True:
+                    try:
+                        item = context.run(next, generator)
+                    except StopIteration:
+                        return
+                    yield item
+            finally:
+                context.run(generator.close)
+        return wrapped_generator
+
+    @wraps(func)
+    def wrapped_function(*args, **kwargs):
+        context = contextvars.copy_context()
+        context.run(session.set, Session())
+        return context.run(func, *args, **kwargs)
+    return wrapped_function
+
+
+class SessionProxy(type):
+    '''
+    Attributes not defined on the class are read from and written to the Session of the current run.
+    '''
+    def __getattr__(cls, name):
+        return getattr(session.get(), name)
+
+    def __setattr__(cls, name, value):
+        if name in cls.__dict__:
+            super().__setattr__(name, value)
+        else:
+            setattr(session.get(), name, value)
+
+
+class Context(metaclass=SessionProxy):
+    # Shared by all sessions: they only depend on shapes and hyperparameters.
+    signatures = OrderedDict()  # LRU of the cell signatures validated in fast mode, keys only
+    max_signatures = 4096
+    structures = StructureCache()
+    lock = threading.Lock()
+    model_locks = weakref.WeakKeyDictionary()  # torch.nn.Module -> threading.RLock
 
     @staticmethod
     def to_device(tensor, device):
         if isinstance(tensor, tuple):
-            return tuple(t.to(device) if t is not None else t for t in tensor)
+            return tuple(Context.to_device(t, device) for t in tensor)
         else:
-            return tensor.to(device) if tensor is not None else tensor
+            return tensor.to(device, non_blocking=True) if isinstance(tensor, torch.Tensor) else tensor
+
+    @staticmethod
+    def to_host(tensor):
+        def copy(tensor):
+            if isinstance(tensor, tuple):
+                return tuple(copy(t) for t in tensor)
+            if not isinstance(tensor, torch.Tensor) or tensor.device.type == 'cpu':
+                return tensor
+            if tensor.device.type == 'cuda':
+                return torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True).copy_(tensor, non_blocking=True)
+            return tensor.cpu()
+
+        if Context.host:
+            return tensor
+        tensor = copy(tensor)
+        if Context.device[0].type == 'cuda':
+            torch.cuda.current_stream(Context.device[0]).synchronize()
+        return tensor
 
     @staticmethod
     def hook_factory(grad_fn):
+        grad_fn_info = Context.grad_fn_info  # Autograd may run the hook on a thread outside the session
+
         def hook(grad_inputs, grad_outputs):
-            Context.grad_fn_info[grad_fn] = {'input': tuple((input.shape, input.dtype) if input is not None else input for input in grad_inputs),
-                                             'output': tuple((output.shape, output.dtype) if output is not None else output for output in grad_outputs)}
+            grad_fn_info[grad_fn] = {'input': tuple((input.shape, input.dtype) if input is not None else input for input in grad_inputs),
+                                     'output': tuple((output.shape, output.dtype) if output is not None else output for output in grad_outputs)}
         return hook
 
     @staticmethod
@@ -91,76 +247,155 @@ class Context:
                 }
 
     @staticmethod
-    def init(model_name, total, device):
-        logging.basicConfig(level=logging.DEBUG, filename='debug.log', filemode='w', format="%(asctime)s - %(levelname)s - %(message)s")
-        Context.bar = tqdm.tqdm(desc=model_name, total=total)
+    def model_lock(model):
+        '''
+        Lock held while a run traces the model, as tracing sets requires_grad, registers hooks and writes .grad on the model itself.
+        '''
+        with Context.lock:
+            return Context.model_locks.setdefault(model, threading.RLock())
+
+    @staticmethod
+    def unseen_signature(*signature):
+        with Context.lock:
+            if signature in Context.signatures:
+                Context.signatures.move_to_end(signature)
+                return False
+            Context.signatures[signature] = None
+            while len(Context.signatures) > Context.max_signatures:
+                Context.signatures.popitem(last=False)
+            return True
+
+    @staticmethod
+    def init(model_name, total, device, fast=False, progress=None, events=None, memory_budget=None):
         Context.device = device
-        Context.grad_fn_info.clear()
+        Context.host = device[0].type == 'cpu'
+        Context.fast = fast
+        Context.memory_budget = memory_budget
+        Context.progress = progress
+        Context.events = events
+        Context.done = 0
+        Context.total = total
+        Context.grad_fn_info = {}
+        Context.snapshots = {}
+        Context.emit(event='start', model=model_name, total=total)
         # multiprocessing.set_start_method('spawn', True)
         # Context.pool = multiprocessing.Pool(len(Context.device))
 
+    @staticmethod
+    def emit(**event):
+        if Context.events is not None:
+            Context.events(event)
+
+    @staticmethod
+    def step(cls, phase, grad_fn, start):
+        Context.done += 1
+        if Context.progress is not None:
+            Context.progress(Context.done, Context.total)
+        Context.emit(event='cell', phase=phase, op=cls.__name__, node=id(grad_fn), seconds=time.perf_counter() - start)
+
     @staticmethod
     def parallel_map(func, iterable):
         return map(lambda res: res.to(Context.device[0]), Context.pool.imap(func, map(lambda args, d: tuple(arg.to(d) if isinstance(arg, torch.Tensor) else arg for arg in args), iterable, itertools.cycle(Context.device))))
 
 
+@dataclass(frozen=True, eq=False, slots=True)
 class GradFn:
-    def __init__(self, grad_fn):
-        self.grad_fn = grad_fn
-        self.ctype = torch.rand(1).element_size()
+    grad_fn: object
+    inputs: Tuple
+    int_type: type
+    attrs: Mapping[str, object] = field(default_factory=lambda: MappingProxyType({}))  # Read-only, so chunks of a tiled node share it
+
+    @staticmethod
+    def of(grad_fn):
+        snapshot = Context.snapshots.get(grad_fn)
+        if snapshot is None:
+            int_type = ctypes.c_int32 if torch.get_default_dtype().itemsize == 4 else ctypes.c_int64
+            attrs = {}
+            for name in dir(grad_fn):
+                if name.startswith('_saved_'):
+                    try:
+                        attrs[name] = GradFn.unsign_to_sign(int_type, name, getattr(grad_fn, name))
+                    except RuntimeError:
+                        pass  # Left to raise again if a cell reads it
+            snapshot = Context.snapshots[grad_fn] = GradFn(grad_fn, Context.grad_fn_info[grad_fn]['input'], int_type, MappingProxyType(attrs))
+        return snapshot
 
     def __call__(self):
-        return tuple(torch.zeros(size=input[0], dtype=input[1], device=Context.device[0]) if input is not None else input for input in Context.grad_fn_info[self.grad_fn]['input'])
+        return tuple(torch.empty(size=input[0], dtype=input[1], device='meta') if input is not None else input for input in self.inputs)
 
     def __getattribute__(self, __name):
-        def unsign_to_sign(attr):
-            if self.ctype == 4:
-                return ctypes.c_int32(attr).value
-            else:
-                return ctypes.c_int64(attr).value
         try:
-            return super().__getattribute__(__name)
+            return object.__getattribute__(self, __name)
         except AttributeError:
-            attr = self.grad_fn.__getattribute__(__name)
-            if __name == '_saved_keepdim':
-                return bool(attr)
-            if __name == '_saved_end':
-                return attr
-            else:
-                if isinstance(attr, int):
-                    attr = unsign_to_sign(attr)
-                if isinstance(attr, tuple):
-                    attr = tuple(unsign_to_sign(a) if isinstance(a, int) else a for a in attr)
-                return attr
+            try:
+                return object.__getattribute__(self, 'attrs')[__name]
+            except KeyError:
+                return getattr(object.__getattribute__(self, 'grad_fn'), __name)
+
+    @staticmethod
+    def unsign_to_sign(int_type, __name, attr):
+        if __name == '_saved_keepdim':
+            return bool(attr)
+        if __name == '_saved_end':
+            return attr
+        if isinstance(attr, int):
+            return int_type(attr).value
+        if isinstance(attr, tuple):
+            return tuple(int_type(a).value if isinstance(a, int) else a for a in attr)
+        return attr
 
 
 class FuncBase:
+    # Whether cell_KQI returns the NaN placeholder that is filled in once W is known:
+    # 'never', 'always' (every output element) or 'partial' (the op must override cell_W to locate them).
+    nan_kqi = 'never'
+    # _saved_ tensors whose contents, not just their shapes, decide the graph (e.g. gather indices).
+    saved_values = ()
+
+    @staticmethod
+    def structure_Caching(func):
+        '''
+        Memoize a helper whose result depends only on the shapes of its tensor arguments and on its other arguments.
+        '''
+        @wraps(func)
+        def wrapped_function(cls, *args):
+            key = (func.__qualname__, Context.device[0], torch.get_default_dtype(), StructureCache.signature(args))
+            return Context.structures.get(key, lambda: func(cls, *args))
+        return wrapped_function
+
     @staticmethod
     def cell_Volume_Checking(args_in: int, args_out: int):
         def cell_Volume_Checking_decorator(func):
             @wraps(func)
             def wrapped_function(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
-                if args_out is not None:
+                validate = not Context.fast or Context.unseen_signature(cls, 'Volume', tuple(getattr(k, 'shape', None) for k in volume_outputs), Context.grad_fn_info[grad_fn]['input'])
+                if validate and args_out is not None:
                     assert len(volume_outputs) == args_out, f"{cls.__name__}.cell_Volume must have exactly {args_out} volume_outputs. {Context.grad_fn_attr_info(grad_fn)}"
 
+                start = time.perf_counter()
                 try:
-                    volume_inputs = Context.to_device(func(cls, GradFn(grad_fn), Context.to_device(volume_outputs, device=Context.device[0])), device=torch.device('cpu'))
+                    if not Context.host:
+                        volume_outputs = Context.to_device(volume_outputs, Context.device[0])
+                    volume_inputs = cls.tiled('Volume', func, GradFn.of(grad_fn), None, volume_outputs)
                 except Exception as err:
-                    logging.debug(f'ERROR!!! {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_Volume\n \
-                              \t\t\t\tvolume_outputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_outputs])}]\n \
-                              \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f'ERROR!!! {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_Volume\n \
+                                     \t\t\t\tvolume_outputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_outputs])}]\n \
+                                     \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
                     raise err
-                Context.bar.update()
-
-                if args_in is not None:
-                    assert len(volume_inputs) == args_in, f"{cls.__name__}.cell_Volume must have exactly {args_in} volume_inputs. {Context.grad_fn_attr_info(grad_fn)}"
-                for volume_in, true_shape in zip(volume_inputs, Context.grad_fn_info[grad_fn]['input']):
-                    if volume_in is not None or true_shape is not None:
-                        assert volume_in.shape == true_shape[0], f"{cls.__name__}.cell_Volume must return the same size of volume_in {volume_in.shape} as true_shape {true_shape[0]}. {Context.grad_fn_attr_info(grad_fn)}"
-                logging.debug(f'{psutil.Process().memory_info().rss/1024**3:.2f} GB - {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_Volume\n \
-                              \t\t\t\tvolume_inputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_inputs])}]\n \
-                              \t\t\t\tvolume_outputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_outputs])}]\n \
-                              \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
+                Context.step(cls, 'Volume', grad_fn, start)
+
+                if validate:
+                    if args_in is not None:
+                        assert len(volume_inputs) == args_in, f"{cls.__name__}.cell_Volume must have exactly {args_in} volume_inputs. {Context.grad_fn_attr_info(grad_fn)}"
+                    for volume_in, true_shape in zip(volume_inputs, Context.grad_fn_info[grad_fn]['input']):
+                        if volume_in is not None or true_shape is not None:
+                            assert volume_in.shape == true_shape[0], f"{cls.__name__}.cell_Volume must return the same size of volume_in {volume_in.shape} as true_shape {true_shape[0]}. {Context.grad_fn_attr_info(grad_fn)}"
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f'{psutil.Process().memory_info().rss/1024**3:.2f} GB - {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_Volume\n \
+                                 \t\t\t\tvolume_inputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_inputs])}]\n \
+                                 \t\t\t\tvolume_outputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_outputs])}]\n \
+                                 \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
                 return volume_inputs
             return wrapped_function
         return cell_Volume_Checking_decorator
@@ -174,27 +409,35 @@ class FuncBase:
         def cell_KQI_Checking_decorator(func):
             @wraps(func)
             def wrapped_function(cls, grad_fn, volume_inputs: Tuple[torch.Tensor], volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
-                if args_out is not None:
-                    assert len(volume_outputs) == args_out, f"{cls.__name__}.cell_KQI must have exactly {args_out} volume_outputs. {Context.grad_fn_attr_info(grad_fn)}"
-                if args_in is not None:
-                    assert len(volume_inputs) == args_in, f"{cls.__name__}.cell_KQI must have exactly {args_in} volume_inputs. {Context.grad_fn_attr_info(grad_fn)}"
-
+                validate = not Context.fast or Context.unseen_signature(cls, 'KQI', tuple(getattr(k, 'shape', None) for k in volume_inputs), tuple(getattr(k, 'shape', None) for k in volume_outputs))
+                if validate:
+                    if args_out is not None:
+                        assert len(volume_outputs) == args_out, f"{cls.__name__}.cell_KQI must have exactly {args_out} volume_outputs. {Context.grad_fn_attr_info(grad_fn)}"
+                    if args_in is not None:
+                        assert len(volume_inputs) == args_in, f"{cls.__name__}.cell_KQI must have exactly {args_in} volume_inputs. {Context.grad_fn_attr_info(grad_fn)}"
+
+                start = time.perf_counter()
                 try:
-                    kqis = Context.to_device(func(cls, GradFn(grad_fn), Context.to_device(volume_inputs, device=Context.device[0]), Context.to_device(volume_outputs, device=Context.device[0])), device=torch.device('cpu'))
+                    if not Context.host:
+                        volume_inputs, volume_outputs = Context.to_device((volume_inputs, volume_outputs), Context.device[0])
+                    kqis = cls.tiled('KQI', func, GradFn.of(grad_fn), volume_inputs, volume_outputs)
                 except Exception as err:
-                    logging.debug(f'ERROR!!! {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_KQI\n \
-                              \t\t\t\tvolume_inputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_inputs])}]\n \
-                              \t\t\t\tvolume_outputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_outputs])}]\n \
-                              \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f'ERROR!!! {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_KQI\n \
+                                     \t\t\t\tvolume_inputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_inputs])}]\n \
+                                     \t\t\t\tvolume_outputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_outputs])}]\n \
+                                     \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
                     raise err
-                Context.bar.update()
-
-                assert len(kqis) == len(volume_outputs), f"{cls.__name__}.cell_KQI must return {len(volume_outputs)} kqis, but now return {len(kqis)} kqis. {Context.grad_fn_attr_info(grad_fn)}"
-                for kqi, volume_out in zip(kqis, volume_outputs):
-                    assert kqi.shape == volume_out.shape, f"{cls.__name__}.cell_KQI must return the same size of volume_output {volume_out.shape} and kqi {kqi.shape}. {Context.grad_fn_attr_info(grad_fn)}"
-                logging.debug(f'{psutil.Process().memory_info().rss/1024**3:.2f} GB - {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_KQI\n \
-                              \t\t\t\tkqi=[{", ".join([f"{k.sum()}/W {k.shape}" if k is not None else "None" for k in kqis])}]\n \
-                              \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
+                Context.step(cls, 'KQI', grad_fn, start)
+
+                if validate:
+                    assert len(kqis) == len(volume_outputs), f"{cls.__name__}.cell_KQI must return {len(volume_outputs)} kqis, but now return {len(kqis)} kqis. {Context.grad_fn_attr_info(grad_fn)}"
+                    for kqi, volume_out in zip(kqis, volume_outputs):
+                        assert kqi.shape == volume_out.shape, f"{cls.__name__}.cell_KQI must return the same size of volume_output {volume_out.shape} and kqi {kqi.shape}. {Context.grad_fn_attr_info(grad_fn)}"
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f'{psutil.Process().memory_info().rss/1024**3:.2f} GB - {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_KQI\n \
+                                 \t\t\t\tkqi=[{", ".join([f"{k.sum()}/W {k.shape}" if k is not None else "None" for k in kqis])}]\n \
+                                 \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
                 return kqis
             return wrapped_function
         return cell_KQI_Checking_decorator
@@ -203,28 +446,214 @@ class FuncBase:
     def cell_KQI(cls, grad_fn, volume_inputs: Tuple[torch.Tensor], volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         raise NotImplementedError(f'Class {cls.__name__} is missing the required cell_KQI function')
 
+    @staticmethod
+    def cell_KQI_sum_Checking(args_in: int, args_out: int):
+        def cell_KQI_sum_Checking_decorator(func):
+            @wraps(func)
+            def wrapped_function(cls, grad_fn, volume_inputs: Tuple[torch.Tensor], volume_outputs: Tuple[torch.Tensor]) -> torch.Tensor:
+                validate = not Context.fast or Context.unseen_signature(cls, 'KQI_sum', tuple(getattr(k, 'shape', None) for k in volume_inputs), tuple(getattr(k, 'shape', None) for k in volume_outputs))
+                if validate:
+                    if args_out is not None:
+                        assert len(volume_outputs) == args_out, f"{cls.__name__}.cell_KQI_sum must have exactly {args_out} volume_outputs. {Context.grad_fn_attr_info(grad_fn)}"
+                    if args_in is not None:
+                        assert len(volume_inputs) == args_in, f"{cls.__name__}.cell_KQI_sum must have exactly {args_in} volume_inputs. {Context.grad_fn_attr_info(grad_fn)}"
+
+                start = time.perf_counter()
+                try:
+                    if not Context.host:
+                        volume_inputs, volume_outputs = Context.to_device((volume_inputs, volume_outputs), Context.device[0])
+                    kqi = cls.tiled('KQI_sum', func, GradFn.of(grad_fn), volume_inputs, volume_outputs)
+                except Exception as err:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f'ERROR!!! {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_KQI_sum\n \
+                                     \t\t\t\tvolume_inputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_inputs])}]\n \
+                                     \t\t\t\tvolume_outputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_outputs])}]\n \
+                                     \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
+                    raise err
+                Context.step(cls, 'KQI', grad_fn, start)
+
+                if validate:
+                    assert kqi.dim() == 0, f"{cls.__name__}.cell_KQI_sum must return a scalar, but now return a tensor of size {kqi.shape}. {Context.grad_fn_attr_info(grad_fn)}"
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f'{psutil.Process().memory_info().rss/1024**3:.2f} GB - {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_KQI_sum\n \
+                                 \t\t\t\tkqi={kqi}/W\n \
+                                 \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
+                return kqi
+            return wrapped_function
+        return cell_KQI_sum_Checking_decorator
+
+    # Optional fused form of cell_KQI(...).sum(), for ops whose per-element KQI is the largest allocation.
+    # Ops that leave it as None are reduced by the generator after cell_KQI.
+    cell_KQI_sum = None
+
+    # Optional re-indexing of a tensor laid out like the output into the layout of the input, for ops that only move elements,
+    # i.e. whose cell_Volume is 1 + layout(out). Such ops walk one volume in place as a chain (see cell_Chain_Checking).
+    layout = None
+
+    # Optional split of an oversized single-output node into chunks fitting Context.memory_budget.
+    # tiling(grad_fn, out) returns the output dim to split along, together with the matching dim of each input,
+    # or None for inputs every chunk needs whole; or it returns None when the node cannot be split.
+    tiling = None
+    # Full-size temporaries a tiled cell keeps alive at once, as a multiple of its output chunk.
+    tiling_temporaries = 4
+
+    @classmethod
+    def tiled(cls, phase: str, func, grad_fn, volume_inputs, volume_outputs):
+        '''
+        Call the cell func on chunks of the output, each small enough for Context.memory_budget, and stitch the results.
+        Inputs split along with the output are sliced. The others are passed whole, and their volumes are summed over the chunks,
+        which is exact as the volume of an input is a sum over the outputs it feeds.
+        '''
+        args = (volume_outputs, ) if phase == 'Volume' else (volume_inputs, volume_outputs)
+        if cls.tiling is None or Context.memory_budget is None or len(volume_outputs) != 1:
+            return func(cls, grad_fn, *args)
+        (out, ) = volume_outputs
+        tiling = cls.tiling(grad_fn, out)
+        if tiling is None or out.numel() * out.element_size() * cls.tiling_temporaries <= Context.memory_budget:
+            return func(cls, grad_fn, *args)
+
+        dim, input_dims = tiling
+        step = max(1, Context.memory_budget // (out.numel() // out.size(dim) * out.element_size() * cls.tiling_temporaries))
+        result = None
+        for start in range(0, out.size(dim), step):
+            length = min(step, out.size(dim) - start)
+            chunk = GradFn(grad_fn.grad_fn, tuple(input if input is None or d is None else (input[0][:d] + (length, ) + input[0][d + 1:], input[1]) for input, d in zip(grad_fn.inputs, input_dims)), grad_fn.int_type, grad_fn.attrs)
+            out_chunk = (out.narrow(dim, start, length), )
+            if phase == 'Volume':
+                part = func(cls, chunk, out_chunk)
+                if result is None:
+                    result = tuple(p if p is None else torch.zeros(input[0], dtype=p.dtype, device=p.device) for p, input in zip(part, grad_fn.inputs))
+                for r, p, d in zip(result, part, input_dims):
+                    if p is not None:
+                        (r if d is None else r.narrow(d, start, length)).add_(p)
+            else:
+                part = func(cls, chunk, tuple(v if v is None or d is None else v.narrow(d, start, length) for v, d in zip(volume_inputs, input_dims)), out_chunk)
+                if phase == 'KQI_sum':
+                    result = part if result is None else result + part
+                else:
+                    if result is None:
+                        result = (torch.empty_like(out), )
+                    result[0].narrow(dim, start, length).copy_(part[0])
+        return result
+
+    @staticmethod
+    def cell_Chain_Checking(phase: str):
+        '''
+        Wrapper of the cells walking a chain of nodes on one volume, advanced in place from the output of the chain's first node towards its input.
+        The Volume cell returns the input volume of the last node, and progress advances once per node of the chain.
+        The KQI cell is a generator yielding the KQI and output volume of each node when asked for, and advances past every node but the last,
+        so progress advances for the KQI of each node as it is reached, and for the Volume of the node before it.
+        '''
+        def cell_Chain_Checking_decorator(func):
+            def log(cls, grad_fns, volume):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f'{psutil.Process().memory_info().rss/1024**3:.2f} GB - {cls.__name__}({",".join(str(id(grad_fn)) for grad_fn in grad_fns)}).cell_{phase}_chain\n \
+                                 \t\t\t\tvolume=[{volume.sum()} {volume.shape}]')
+
+            if phase == 'Volume':
+                @wraps(func)
+                def wrapped_function(cls, grad_fns: Tuple, volume: torch.Tensor) -> torch.Tensor:
+                    validate = not Context.fast or Context.unseen_signature(cls, 'Volume_chain', tuple(grad_fn.name() for grad_fn in grad_fns), volume.shape)
+
+                    start = time.perf_counter()
+                    if not Context.host:
+                        volume = Context.to_device(volume, Context.device[0])
+                    result = func(cls, grad_fns, volume)
+                    share = (time.perf_counter() - start) / len(grad_fns)
+                    for grad_fn in grad_fns:
+                        Context.step(cls, phase, grad_fn, time.perf_counter() - share)
+
+                    if validate:
+                        true_shape = Context.grad_fn_info[grad_fns[-1]]['input'][0][0]
+                        assert result.shape == true_shape, f"{cls.__name__}.cell_Volume_chain must return the same size of volume_in {result.shape} as true_shape {true_shape}. {Context.grad_fn_attr_info(grad_fns[-1])}"
+                    log(cls, grad_fns, result)
+                    return result
+                return wrapped_function
+
+            @wraps(func)
+            def wrapped_generator(cls, grad_fns: Tuple, volume: torch.Tensor) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+                validate = not Context.fast or Context.unseen_signature(cls, 'KQI_chain', tuple(grad_fn.name() for grad_fn in grad_fns), volume.shape)
+
+                start = time.perf_counter()
+                if not Context.host:
+                    volume = Context.to_device(volume, Context.device[0])
+                for k, (grad_fn, (kqi, volume)) in enumerate(zip(grad_fns, func(cls, grad_fns, volume))):
+                    if k > 0:
+                        Context.step(cls, 'Volume', grad_fns[k - 1], start)
+                    Context.step(cls, phase, grad_fn, start)
+
+                    if validate:
+                        true_shape = Context.grad_fn_info[grad_fn]['output'][0][0]
+                        assert kqi.shape == volume.shape == true_shape, f"{cls.__name__}.cell_KQI_chain must yield the same size of kqi_out {kqi.shape} and volume_out {volume.shape} as true_shape {true_shape}. {Context.grad_fn_attr_info(grad_fn)}"
+                    log(cls, (grad_fn, ), volume)
+                    yield kqi, volume
+                    start = time.perf_counter()
+            return wrapped_generator
+        return cell_Chain_Checking_decorator
+
+    @staticmethod
+    def cell_W_Checking(args_out: int):
+        def cell_W_Checking_decorator(func):
+            @wraps(func)
+            def wrapped_function(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> torch.Tensor:
+                if not Context.fast or Context.unseen_signature(cls, 'W', len(volume_outputs)):
+                    if args_out is not None:
+                        assert len(volume_outputs) == args_out, f"{cls.__name__}.cell_W must have exactly {args_out} volume_outputs. {Context.grad_fn_attr_info(grad_fn)}"
+
+                try:
+                    if not Context.host:
+                        volume_outputs = Context.to_device(volume_outputs, Context.device[0])
+                    w = func(cls, GradFn.of(grad_fn), volume_outputs)
+                except Exception as err:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f'ERROR!!! {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_W\n \
+                                     \t\t\t\tvolume_outputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in volume_outputs])}]\n \
+                                     \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
+                    raise err
+                return w
+            return wrapped_function
+        return cell_W_Checking_decorator
+
+    @classmethod
+    def cell_W(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> torch.Tensor:
+        '''
+        Contribution of this node to W: the sum of 1 + volume over the outputs whose cell_KQI is the NaN placeholder.
+        '''
+        if cls.nan_kqi == 'never':
+            return 0
+        if cls.nan_kqi == 'always':
+            return sum(vO.numel() + vO.sum() for vO in volume_outputs)
+        raise NotImplementedError(f'Class {cls.__name__} is missing the required cell_W function')
+
     @staticmethod
     def cell_Graph_Checking(args_in: int, args_out: int):
         def cell_Graph_Checking_decorator(func):
             @wraps(func)
             def wrapped_function(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
-                if args_out is not None:
-                    assert len(outputs) == args_out, f"{cls.__name__}.cell_Graph must have exactly {args_out} outputs. {Context.grad_fn_attr_info(grad_fn)}"
-                if args_in is not None:
-                    assert len(inputs) == args_in, f"{cls.__name__}.cell_Graph must have exactly {args_in} inputs. {Context.grad_fn_attr_info(grad_fn)}"
+                if not Context.fast or Context.unseen_signature(cls, 'Graph', len(inputs), len(outputs)):
+                    if args_out is not None:
+                        assert len(outputs) == args_out, f"{cls.__name__}.cell_Graph must have exactly {args_out} outputs. {Context.grad_fn_attr_info(grad_fn)}"
+                    if args_in is not None:
+                        assert len(inputs) == args_in, f"{cls.__name__}.cell_Graph must have exactly {args_in} inputs. {Context.grad_fn_attr_info(grad_fn)}"
 
+                start = time.perf_counter()
                 try:
-                    adj = func(cls, GradFn(grad_fn), Context.to_device(inputs, device=Context.device[0]), Context.to_device(outputs, device=Context.device[0]))
+                    if not Context.host:
+                        inputs, outputs = Context.to_device((inputs, outputs), Context.device[0])
+                    adj = func(cls, GradFn.of(grad_fn), inputs, outputs)
                 except Exception as err:
-                    logging.debug(f'ERROR!!! {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_Graph\n \
-                              \t\t\t\tinputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in inputs])}]\n \
-                              \t\t\t\toutputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in outputs])}]\n \
-                              \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f'ERROR!!! {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_Graph\n \
+                                     \t\t\t\tinputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in inputs])}]\n \
+                                     \t\t\t\toutputs=[{", ".join([f"{k.sum()} {k.shape}" if k is not None else "None" for k in outputs])}]\n \
+                                     \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
                     raise err
+                Context.emit(event='cell', phase='Graph', op=cls.__name__, node=id(grad_fn), seconds=time.perf_counter() - start)
 
-                logging.debug(f'{psutil.Process().memory_info().rss/1024**3:.2f} GB - {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_Graph\n \
-                              \t\t\t\tnodes={len(adj)}, edges={sum(map(len, adj.values()))}\n \
-                              \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f'{psutil.Process().memory_info().rss/1024**3:.2f} GB - {cls.__name__}({id(grad_fn)}<-{",".join(map(lambda k: str(id(k[0])), grad_fn.next_functions))}).cell_Graph\n \
+                                 \t\t\t\tnodes={len(adj)}, edges={sum(map(len, adj.values()))}\n \
+                                 \t\t\t\tgrad_fn={Context.grad_fn_attr_info(grad_fn)}')
                 return adj
             return wrapped_function
         return cell_Graph_Checking_decorator
@@ -233,19 +662,34 @@ class FuncBase:
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
         raise NotImplementedError(f'Class {cls.__name__} is missing the required cell_Graph function')
 
+    @staticmethod
+    def adjacency(outputs: torch.Tensor, inputs: torch.Tensor) -> Dict[int, Tuple[int]]:
+        '''
+        Build the result of cell_Graph from index arrays, where inputs holds the predecessors of each node of outputs along its trailing dims.
+        '''
+        return dict(zip(outputs.flatten().long().tolist(), map(tuple, inputs.reshape(outputs.numel(), -1).long().tolist())))
+
     @staticmethod
     def temporary_KQI(volume: torch.Tensor, volume_backward: torch.Tensor) -> torch.Tensor:
         '''
         This function provides a way to compute the temporary KQI (without divide by W).
         Remember to divide by W before returning the final KQI value.
         The volume parameter and the volume_backward parameter should be the same shape, unless the volume_backward is a scalar.
+        Elements with zero volume have zero KQI, also where volume_backward is zero, e.g. the output node or padding that feeds nothing.
         '''
         if volume_backward.dim() != 0 and volume.shape != volume_backward.shape:
             raise ValueError(f'Shape of volume {volume.shape} is incompatible with volume_backward {volume_backward.shape}')
 
-        ret = torch.where(volume == 0, volume_backward, volume)
-        ret.div_(volume_backward)
+        ret = volume.div(volume_backward).masked_fill_(volume == 0, 1)
         ret.log2_()
         ret.mul_(volume)
         ret.neg_()
         return ret
+
+    @staticmethod
+    def temporary_KQI_self(volume: torch.Tensor) -> torch.Tensor:
+        '''
+        This function provides the sum of volume * log2(volume), accumulated in float64.
+        It lets cell_KQI_sum expand sum(temporary_KQI(volume, volume_backward)) as sum(volume * log2(volume_backward)) - temporary_KQI_self(volume).
+        '''
+        return torch.special.xlogy(volume, volume).sum(dtype=torch.float64) / math.log(2)
@@ -3,12 +3,14 @@ import itertools
 import numpy as np
 import math
 from collections import defaultdict
-from .function_base import FuncBase as FB, Context
-from typing import Tuple, Dict
+from .function_base import FuncBase as FB, Context, GradFn
+from typing import Tuple, Dict, Iterator
 import random
 
 
 class AccumulateGrad(FB):
+    nan_kqi = 'always'
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=0, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -29,6 +31,10 @@ class AccumulateGrad(FB):
 
 
 class TBackward0(FB):
+    @classmethod
+    def layout(cls, grad_fn, volume: torch.Tensor) -> torch.Tensor:
+        return volume.T
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -80,6 +86,19 @@ class MvBackward0(FB):
             kqi_out = FB.temporary_KQI(out.unsqueeze(1).expand(size) / size[1], vec.unsqueeze(0).expand(size)).sum(1)
         return (kqi_out, )
 
+    @classmethod
+    @FB.cell_KQI_sum_Checking(args_in=2, args_out=1)
+    def cell_KQI_sum(cls, grad_fn, volume_inputs: Tuple[torch.Tensor], volume_outputs: Tuple[torch.Tensor]) -> torch.Tensor:
+        (mat, vec), (out, ) = volume_inputs, volume_outputs
+        degree = (mat.shape[1] if mat is not None else vec.shape[0]) * ((mat is not None) + (vec is not None))
+        out = out / degree
+        kqi = -degree * FB.temporary_KQI_self(out)
+        if mat is not None:
+            kqi += (out.double() * mat.log2().sum(1, dtype=torch.float64)).sum()
+        if vec is not None:
+            kqi += out.sum(dtype=torch.float64) * vec.log2().sum(dtype=torch.float64)
+        return kqi
+
     @classmethod
     @FB.cell_Graph_Checking(args_in=2, args_out=1)
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
@@ -94,6 +113,10 @@ class MvBackward0(FB):
 
 
 class MmBackward0(FB):
+    @classmethod
+    def tiling(cls, grad_fn, out: torch.Tensor):
+        return 0, (0, None)
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=2, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -126,6 +149,19 @@ class MmBackward0(FB):
                 kqi_out += FB.temporary_KQI(out / (size[1]), mat2[i:i + 1, :].expand_as(out))
         return (kqi_out, )
 
+    @classmethod
+    @FB.cell_KQI_sum_Checking(args_in=2, args_out=1)
+    def cell_KQI_sum(cls, grad_fn, volume_inputs: Tuple[torch.Tensor], volume_outputs: Tuple[torch.Tensor]) -> torch.Tensor:
+        (mat1, mat2), (out, ) = volume_inputs, volume_outputs
+        degree = (mat1.shape[1] if mat1 is not None else mat2.shape[0]) * ((mat1 is not None) + (mat2 is not None))
+        out = out / degree
+        kqi = -degree * FB.temporary_KQI_self(out)
+        if mat1 is not None:
+            kqi += (out.sum(1, dtype=torch.float64) * mat1.log2().sum(1, dtype=torch.float64)).sum()
+        if mat2 is not None:
+            kqi += (out.sum(0, dtype=torch.float64) * mat2.log2().sum(0, dtype=torch.float64)).sum()
+        return kqi
+
     @classmethod
     @FB.cell_Graph_Checking(args_in=2, args_out=1)
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
@@ -162,6 +198,35 @@ class OnetoOneMapping(FB):
         adj = {int(o): (int(i), ) for i, o in zip(torch.flatten(input), torch.flatten(out))}
         return adj
 
+    @classmethod
+    def layout(cls, grad_fn, volume: torch.Tensor) -> torch.Tensor:
+        return volume
+
+    @classmethod
+    @FB.cell_Chain_Checking(phase='Volume')
+    def cell_Volume_chain(cls, grad_fns: Tuple, volume_output: torch.Tensor) -> torch.Tensor:
+        '''
+        Input volume of grad_fns[-1] along a chain grad_fns[0] <- grad_fns[1] <- ... of nodes with a layout, where each node feeds only the previous one,
+        given the output volume of grad_fns[0]. volume_output is advanced in place, and the result is a view of it wherever the layouts allow it.
+        '''
+        volume = volume_output.add_(len(grad_fns))
+        for grad_fn in grad_fns:
+            volume = backward_mapper(grad_fn).layout(GradFn.of(grad_fn), volume)
+        return volume
+
+    @classmethod
+    @FB.cell_Chain_Checking(phase='KQI')
+    def cell_KQI_chain(cls, grad_fns: Tuple, volume_output: torch.Tensor) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        '''
+        KQI and output volume of each node along a chain as in cell_Volume_chain, computed when asked for.
+        volume_output is advanced in place past a node once the next one is asked for, so the volumes yielded are views of one buffer that moves on.
+        '''
+        volume = volume_output
+        for k, grad_fn in enumerate(grad_fns):
+            if k > 0:
+                volume = backward_mapper(grad_fns[k - 1]).layout(GradFn.of(grad_fns[k - 1]), volume.add_(1))
+            yield FB.temporary_KQI(volume, volume + 1), volume
+
 
 class ToCopyBackward0(OnetoOneMapping):
     pass
@@ -316,6 +381,7 @@ class CopySlices(FB):
         return {k: tuple(v) for k, v in adj.items()}
 
     @classmethod
+    @FB.structure_Caching
     def degree(cls, inputs, out):
         degree = torch.zeros(out.shape, device=Context.device[0])
         for input in inputs:
@@ -336,6 +402,8 @@ class ROIAlign(FB):
         input = torch.zeros_like(input, device=Context.device[0])
         for i, (x_start, y_start) in enumerate(selected_regions):
             input[0, :, y_start:y_start + out.shape[2], x_start:x_start + out.shape[3]] = 1 + out[i]
+        if roi is not None:
+            roi = torch.zeros_like(roi, device=Context.device[0])
         return (input, roi)
 
     @classmethod
@@ -489,12 +557,15 @@ class SelectBackward0(FB):
 
 
 class SqueezeBackward1(FB):
+    @classmethod
+    def layout(cls, grad_fn, volume: torch.Tensor) -> torch.Tensor:
+        return torch.unsqueeze(volume, grad_fn.__getattribute__('_saved_dim'))
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, ), (out, ) = grad_fn(), volume_outputs
         dim = grad_fn.__getattribute__('_saved_dim')
-        input = torch.zeros_like(input, device=Context.device[0])
         input = 1 + torch.unsqueeze(out, dim)
         return (input, )
 
@@ -516,6 +587,10 @@ class SqueezeBackward1(FB):
 
 
 class UnsqueezeBackward0(FB):
+    @classmethod
+    def layout(cls, grad_fn, volume: torch.Tensor) -> torch.Tensor:
+        return volume.squeeze(dim=grad_fn.__getattribute__('_saved_dim'))
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -547,7 +622,7 @@ class StackBackward0(FB):
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         inputs, (out, ) = grad_fn(), volume_outputs
         dim = grad_fn.__getattribute__('_saved_dim')
-        inputs = tuple(torch.zeros_like(input, device=Context.device[0]) + 1 + out.select(dim, index) for index, input in enumerate(inputs))
+        inputs = tuple(1 + out.select(dim, index) for index in range(len(inputs)))
         return inputs
 
     @classmethod
@@ -600,7 +675,7 @@ class UnbindBackward0(FB):
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, ), outputs = grad_fn(), volume_outputs
         dim = grad_fn.__getattribute__('_saved_dim')
-        input = torch.zeros_like(input, device=Context.device[0]) + 1 + torch.stack(outputs, dim)
+        input = 1 + torch.stack(outputs, dim)
         return (input, )
 
     @classmethod
@@ -626,7 +701,7 @@ class UnsafeSplitBackward0(FB):
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, ), outputs = grad_fn(), volume_outputs
         dim = grad_fn.__getattribute__('_saved_dim')
-        input = torch.zeros_like(input, device=Context.device[0]) + 1 + torch.cat(outputs, dim)
+        input = 1 + torch.cat(outputs, dim)
         return (input, )
 
     @classmethod
@@ -647,6 +722,11 @@ class UnsafeSplitBackward0(FB):
 
 
 class ViewBackward0(FB):
+    @classmethod
+    def layout(cls, grad_fn, volume: torch.Tensor) -> torch.Tensor:
+        (input, ) = grad_fn()
+        return volume.reshape(input.shape)
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -674,6 +754,11 @@ class UnsafeViewBackward0(ViewBackward0):
 
 
 class ReshapeAliasBackward0(FB):
+    @classmethod
+    def layout(cls, grad_fn, volume: torch.Tensor) -> torch.Tensor:
+        (input, ) = grad_fn()
+        return volume.reshape_as(input)
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -702,7 +787,7 @@ class AsStridedBackward0(FB):
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, ), (out, ) = grad_fn(), volume_outputs
         size, stride, storage_offset = grad_fn.__getattribute__('_saved_size'), grad_fn.__getattribute__('_saved_stride'), grad_fn.__getattribute__('_saved_storage_offset')
-        torch.zero_(input)
+        input = torch.zeros_like(input, device=Context.device[0])
         torch.as_strided(input, size, stride, storage_offset).add_(1 + out)
         return (input, )
 
@@ -865,6 +950,7 @@ class ConvolutionBackward0(FB):
         return {k: tuple(v) for k, v in adj.items()}
 
     @classmethod
+    @FB.structure_Caching
     def degree(cls, input, weight, bias, saved_input, degree_size, kernel_size, dilation, stride, padding, transposed):
         degree = torch.zeros(degree_size, device=Context.device[0])
         ndim = len(degree_size)
@@ -899,12 +985,18 @@ class ConvolutionBackward0(FB):
 
 
 class SoftmaxBackward0(FB):
+    @classmethod
+    def tiling(cls, grad_fn, out: torch.Tensor):
+        if out.dim() < 2:
+            return None
+        dim = 1 if grad_fn.__getattribute__('_saved_dim') % out.dim() == 0 else 0
+        return dim, (dim, )
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, ), (out, ) = grad_fn(), volume_outputs
         dim = grad_fn.__getattribute__('_saved_dim')
-        input = torch.zeros_like(input, device=Context.device[0])
         input = torch.mean(out, dim, True).expand_as(out) + out.size(dim)
         return (input, )
 
@@ -919,12 +1011,24 @@ class SoftmaxBackward0(FB):
         #     kqi_out.add_(FB.temporary_KQI(out / out.size(dim), i.unsqueeze(dim).expand_as(out)))
         return (kqi_out, )
 
+    @classmethod
+    @FB.cell_KQI_sum_Checking(args_in=1, args_out=1)
+    def cell_KQI_sum(cls, grad_fn, volume_inputs: Tuple[torch.Tensor], volume_outputs: Tuple[torch.Tensor]) -> torch.Tensor:
+        (input, ), (out, ) = volume_inputs, volume_outputs
+        dim = grad_fn.__getattribute__('_saved_dim')
+        degree = out.size(dim)
+        out = out / degree
+        kqi = -degree * FB.temporary_KQI_self(out)
+        kqi += (out.sum(dim, dtype=torch.float64) * input.log2().sum(dim, dtype=torch.float64)).sum()
+        return kqi
+
     @classmethod
     @FB.cell_Graph_Checking(args_in=1, args_out=1)
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
         (input, ), (out, ) = inputs, outputs
         dim = grad_fn.__getattribute__('_saved_dim')
-        adj = {int(o): tuple(int(i) for i in ii) for id in range(out.size(dim)) for ii, o in zip(torch.flatten(torch.stack(input.unbind(dim), -1), 0, -2), torch.flatten(out.select(dim, id)))}
+        out = out.movedim(dim, -1)
+        adj = FB.adjacency(out, input.movedim(dim, -1).unsqueeze(-2).expand(*out.shape, -1))
         return adj
 
 
@@ -1113,6 +1217,11 @@ class GluBackward0(FB):
 
 
 class AddmmBackward0(FB):
+    @classmethod
+    def tiling(cls, grad_fn, out: torch.Tensor):
+        (input, mat1, mat2) = grad_fn()
+        return 0, (0 if input is not None and input.dim() == 2 and input.shape[0] != 1 else None, 0, None)
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=3, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -1144,6 +1253,22 @@ class AddmmBackward0(FB):
                 kqi_out += FB.temporary_KQI(out / degree, mat2[i:i + 1, :].expand_as(out))
         return (kqi_out, )
 
+    @classmethod
+    @FB.cell_KQI_sum_Checking(args_in=3, args_out=1)
+    def cell_KQI_sum(cls, grad_fn, volume_inputs: Tuple[torch.Tensor], volume_outputs: Tuple[torch.Tensor]) -> torch.Tensor:
+        (input, mat1, mat2), (out, ) = volume_inputs, volume_outputs
+        size = (out.shape[0], mat1.shape[1] if mat1 is not None else mat2.shape[0], out.shape[1])
+        degree = cls.degree(input, mat1, mat2, size)
+        out = out / degree
+        kqi = -degree * FB.temporary_KQI_self(out)
+        if input is not None:
+            kqi += (out.sum_to_size(input.shape).double() * input.log2()).sum()
+        if mat1 is not None:
+            kqi += (out.sum(1, dtype=torch.float64) * mat1.log2().sum(1, dtype=torch.float64)).sum()
+        if mat2 is not None:
+            kqi += (out.sum(0, dtype=torch.float64) * mat2.log2().sum(0, dtype=torch.float64)).sum()
+        return kqi
+
     @classmethod
     @FB.cell_Graph_Checking(args_in=3, args_out=1)
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
@@ -1178,6 +1303,10 @@ class AddmmBackward0(FB):
 
 
 class TransposeBackward0(FB):
+    @classmethod
+    def layout(cls, grad_fn, volume: torch.Tensor) -> torch.Tensor:
+        return volume.transpose(grad_fn.__getattribute__('_saved_dim0'), grad_fn.__getattribute__('_saved_dim1'))
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -1204,6 +1333,10 @@ class TransposeBackward0(FB):
 
 
 class BmmBackward0(FB):
+    @classmethod
+    def tiling(cls, grad_fn, out: torch.Tensor):
+        return 1, (1, None)
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=2, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -1236,6 +1369,19 @@ class BmmBackward0(FB):
                 kqi_out += FB.temporary_KQI(out / size[2], mat2[:, i:i + 1, :].expand_as(out))
         return (kqi_out, )
 
+    @classmethod
+    @FB.cell_KQI_sum_Checking(args_in=2, args_out=1)
+    def cell_KQI_sum(cls, grad_fn, volume_inputs: Tuple[torch.Tensor], volume_outputs: Tuple[torch.Tensor]) -> torch.Tensor:
+        (mat1, mat2), (out, ) = volume_inputs, volume_outputs
+        degree = (mat1.shape[2] if mat1 is not None else mat2.shape[1]) * ((mat1 is not None) + (mat2 is not None))
+        out = out / degree
+        kqi = -degree * FB.temporary_KQI_self(out)
+        if mat1 is not None:
+            kqi += (out.sum(2, dtype=torch.float64) * mat1.log2().sum(2, dtype=torch.float64)).sum()
+        if mat2 is not None:
+            kqi += (out.sum(1, dtype=torch.float64) * mat2.log2().sum(1, dtype=torch.float64)).sum()
+        return kqi
+
     @classmethod
     @FB.cell_Graph_Checking(args_in=2, args_out=1)
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
@@ -1256,7 +1402,7 @@ class SplitBackward0(FB):
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, ), outputs = grad_fn(), volume_outputs
         dim = grad_fn.__getattribute__('_saved_dim')
-        input = torch.zeros_like(input, device=Context.device[0]) + 1 + torch.cat(outputs, dim)
+        input = 1 + torch.cat(outputs, dim)
         return (input, )
 
     @classmethod
@@ -1395,12 +1541,15 @@ class NativeGroupNormBackward0(FB):
         num = np.prod(saved_input.shape[1:]) / group
         degree = cls.degree(input, weight, bias, num)
         if input is not None:
+            input = torch.zeros_like(input, device=Context.device[0])
             for i in range(0, channel, stride):
                 input[:, i:i + stride, :, :] = num + (out[:, i:i + stride, :, :] / degree).sum()
         if weight is not None:
+            weight = torch.zeros_like(weight, device=Context.device[0])
             for i in range(0, channel, stride):
                 weight[i] = num + (out[:, i:i + stride, :, :] / degree).sum()
         if bias is not None:
+            bias = torch.zeros_like(bias, device=Context.device[0])
             for i in range(0, channel, stride):
                 bias[i] = num + (out[:, i:i + stride, :, :] / degree).sum()
         return (input, weight, bias)
@@ -1565,7 +1714,7 @@ class SumBackward1(FB):
         (input, ), (out, ) = inputs, outputs
         dim = grad_fn.__getattribute__('_saved_dim')
         dim = tuple(sorted(d if d >= 0 else input.dim() + d for d in dim))
-        adj = {int(o.item()): tuple(int(i.item()) for i in torch.flatten(i_list)) for i_list, o in zip(torch.flatten(input.permute(tuple(d for d in range(input.dim()) if d not in dim) + dim), end_dim=input.dim() - len(dim) - 1), torch.flatten(out))}
+        adj = FB.adjacency(out, input.permute(tuple(d for d in range(input.dim()) if d not in dim) + dim))
         return adj
 
 
@@ -1601,10 +1750,8 @@ class ExpandBackward0(FB):
     @FB.cell_Graph_Checking(args_in=1, args_out=1)
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
         (input, ), (out, ) = inputs, outputs
-        adj = defaultdict(list)
-        for i, o in zip(torch.flatten(input), torch.flatten(out.sum_to_size(input.shape))):
-            adj[int(o)].append(int(i))
-        return {k: tuple(v) for k, v in adj.items()}
+        adj = FB.adjacency(out, input.expand_as(out))
+        return adj
 
 
 class MeanBackward0(FB):
@@ -1704,6 +1851,7 @@ class AvgPoolBackward0(FB):
         return {k: tuple(v) for k, v in adj.items()}
 
     @classmethod
+    @FB.structure_Caching
     def degree(cls, input, out, kernel_size, stride, padding):
         degree = torch.zeros_like(out, device=Context.device[0])
         ndim = len(kernel_size)
@@ -1800,6 +1948,7 @@ class AdaptivePoolBackward0(FB):
         return {k: tuple(v) for k, v in adj.items()}
 
     @classmethod
+    @FB.structure_Caching
     def degree(cls, input, out, kernel_size, stride, padding):
         degree = torch.zeros_like(out, device=Context.device[0])
         ndim = input.dim() - 1
@@ -1892,6 +2041,7 @@ class MaxPoolBackward0(FB):
         return {k: tuple(v) for k, v in adj.items()}
 
     @classmethod
+    @FB.structure_Caching
     def degree(cls, input, out, kernel_size, stride, padding, dilation):
         degree = torch.zeros_like(out, device=Context.device[0])
         ndim = len(kernel_size)
@@ -1920,6 +2070,8 @@ class AdaptiveMaxPool3DBackward0(AdaptivePoolBackward0):
 
 
 class EmbeddingBackward0(FB):
+    saved_values = ('_saved_indices', )
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -1950,6 +2102,8 @@ class EmbeddingBackward0(FB):
 
 
 class ConstantPadNdBackward0(FB):
+    nan_kqi = 'partial'
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -1966,6 +2120,14 @@ class ConstantPadNdBackward0(FB):
         kqi_out = FB.temporary_KQI(out, torch.nn.functional.pad(input, pad, value=float('nan')))
         return (kqi_out, )
 
+    @classmethod
+    @FB.cell_W_Checking(args_out=1)
+    def cell_W(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> torch.Tensor:
+        (input, ), (out, ) = grad_fn(), volume_outputs
+        pad = grad_fn.__getattribute__('_saved_pad')
+        mask = torch.nn.functional.pad(torch.zeros_like(input, device=Context.device[0]), pad, value=float('nan')).isnan()
+        return mask.sum() + out.masked_select(mask).sum()
+
     @classmethod
     @FB.cell_Graph_Checking(args_in=1, args_out=1)
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
@@ -2082,6 +2244,8 @@ class PixelUnshuffleBackward0(FB):
 
 
 class Im2ColBackward0(FB):
+    nan_kqi = 'partial'
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -2091,68 +2255,39 @@ class Im2ColBackward0(FB):
         stride = grad_fn.__getattribute__('_saved_stride')
         dilation = grad_fn.__getattribute__('_saved_dilation')
 
-        input_padding = torch.zeros(input.shape[:2] + tuple(input.shape[i] + 2 * padding[i - 2] for i in range(2, 4)), device=Context.device[0])
-        end = [None if padding[i] == 0 else -padding[i] for i in range(2)]
-
-        _, channels, Hin, Win = input.shape
-        dilated_h, dilated_w = [(k - 1) * d + 1 for k, d in zip(kernel_size, dilation)]
-        Hout, Wout = [(i + 2 * pad - d) // s + 1 for i, pad, d, s in zip((Hin, Win), padding, (dilated_h, dilated_w), stride)]
-
-        indexing = lambda c, i, j: [slice(None), c, slice(i, Hout * stride[0] + i, stride[0]), slice(j, Wout * stride[1] + j, stride[1])]
-        index = 0
-        for c, i, j in itertools.product(range(channels), range(0, kernel_size[0] * dilation[0], dilation[0]), range(0, kernel_size[1] * dilation[1], dilation[1])):
-            input_padding[indexing(c, i, j)] += 1 + out[:, index, :].reshape(-1, Hout, Wout)
-            index += 1
-
-        input = input_padding[[slice(None)] * 2 + [slice(padding[i], end[i]) for i in range(2)]].clone()
+        input = torch.nn.functional.fold(1 + out, input.shape[-2:], kernel_size, dilation=dilation, padding=padding, stride=stride).to(input.dtype)
         return (input, )
 
     @classmethod
     @FB.cell_KQI_Checking(args_in=1, args_out=1)
     def cell_KQI(cls, grad_fn, volume_inputs: Tuple[torch.Tensor], volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, ), (out, ) = volume_inputs, volume_outputs
-        kernel_size = grad_fn.__getattribute__('_saved_kernel_size')
-        padding = grad_fn.__getattribute__('_saved_padding')
-        stride = grad_fn.__getattribute__('_saved_stride')
-        dilation = grad_fn.__getattribute__('_saved_dilation')
-
-        _, channels, Hin, Win = input.shape
-        dilated_h, dilated_w = [(k - 1) * d + 1 for k, d in zip(kernel_size, dilation)]
-        Hout, Wout = [(i + 2 * pad - d) // s + 1 for i, pad, d, s in zip((Hin, Win), padding, (dilated_h, dilated_w), stride)]
-
-        kqi_out = torch.zeros_like(out, device=Context.device[0])
-        input_padding = torch.nn.functional.pad(input, (padding[0], padding[0], padding[1], padding[1]), value=float('nan'))
-
-        indexing = lambda c, i, j: [slice(None), c, slice(i, Hout * stride[0] + i, stride[0]), slice(j, Wout * stride[1] + j, stride[1])]
-        index = 0
-        for c, i, j in itertools.product(range(channels), range(0, kernel_size[0] * dilation[0], dilation[0]), range(0, kernel_size[1] * dilation[1], dilation[1])):
-            kqi_out[:, index, :] += FB.temporary_KQI(out[:, index, :], input_padding[indexing(c, i, j)].reshape(-1, Hout * Wout))
-            index += 1
-
+        kqi_out = FB.temporary_KQI(out, cls.unfold(grad_fn, input))
         return (kqi_out,)
 
+    @classmethod
+    @FB.cell_W_Checking(args_out=1)
+    def cell_W(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> torch.Tensor:
+        (input, ), (out, ) = grad_fn(), volume_outputs
+        mask = cls.unfold(grad_fn, torch.zeros_like(input, device=Context.device[0])).isnan()
+        return mask.sum() + out.masked_select(mask).sum()
+
     @classmethod
     @FB.cell_Graph_Checking(args_in=1, args_out=1)
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
         (input, ), (out, ) = inputs, outputs
+        adj = {int(o): (int(i), ) if i == i else tuple() for i, o in zip(torch.flatten(cls.unfold(grad_fn, input)), torch.flatten(out))}
+        return adj
+
+    @classmethod
+    def unfold(cls, grad_fn, tensor):
+        # Like the forward unfold, but padded positions read NaN instead of zero.
         kernel_size = grad_fn.__getattribute__('_saved_kernel_size')
         padding = grad_fn.__getattribute__('_saved_padding')
         stride = grad_fn.__getattribute__('_saved_stride')
         dilation = grad_fn.__getattribute__('_saved_dilation')
-
-        _, channels, Hin, Win = input.shape
-        dilated_h, dilated_w = [(k - 1) * d + 1 for k, d in zip(kernel_size, dilation)]
-        Hout, Wout = [(i + 2 * pad - d) // s + 1 for i, pad, d, s in zip((Hin, Win), padding, (dilated_h, dilated_w), stride)]
-
-        input_padding = torch.nn.functional.pad(input, (padding[0], padding[0], padding[1], padding[1]), value=float('nan'))
-        indexing = lambda c, i, j: [slice(None), c, slice(i, Hout * stride[0] + i, stride[0]), slice(j, Wout * stride[1] + j, stride[1])]
-        index = 0
-        adj = defaultdict(list)
-        for c, i, j in itertools.product(range(channels), range(0, kernel_size[0] * dilation[0], dilation[0]), range(0, kernel_size[1] * dilation[1], dilation[1])):
-            for i, o in zip(torch.flatten(input_padding[indexing(c, i, j)]), torch.flatten(out[:, index, :])):
-                adj[int(o)].append(int(i)) if i == i else tuple()
-            index += 1
-        return {k: tuple(v) for k, v in adj.items()}
+        tensor = torch.nn.functional.pad(tensor, (padding[1], padding[1], padding[0], padding[0]), value=float('nan'))
+        return torch.nn.functional.unfold(tensor, kernel_size, dilation=dilation, stride=stride)
 
 
 class Col2ImBackward0(FB):
@@ -2165,17 +2300,9 @@ class Col2ImBackward0(FB):
         stride = grad_fn.__getattribute__('_saved_stride')
         dilation = grad_fn.__getattribute__('_saved_dilation')
 
-        _, channels, Hout, Wout = out.shape
-        dilated_h, dilated_w = [(k - 1) * d + 1 for k, d in zip(kernel_size, dilation)]
-        Hin, Win = [(i + 2 * pad - d) // s + 1 for i, pad, d, s in zip((Hout, Wout), padding, (dilated_h, dilated_w), stride)]
-        out_padding = torch.nn.functional.pad(out, (padding[0], padding[0], padding[1], padding[1]), value=0)
-        degree = cls.degree(Hin, Win, out, kernel_size, stride, padding, dilation)
-
-        indexing = lambda c, i, j: [slice(None), c, slice(i, Hin * stride[0] + i, stride[0]), slice(j, Win * stride[1] + j, stride[1])]
-        index = 0
-        for c, i, j in itertools.product(range(channels), range(0, kernel_size[0] * dilation[0], dilation[0]), range(0, kernel_size[1] * dilation[1], dilation[1])):
-            input[:, index, :] += 1 + (out_padding / degree)[indexing(c, i, j)].reshape(-1, Hin * Win)
-            index += 1
+        degree = cls.degree(input, out, kernel_size, stride, padding, dilation)
+        # Entries summed into the padding reach no output, so they read 0 from the zero padding.
+        input = torch.nn.functional.unfold(1 + out / degree, kernel_size, dilation=dilation, padding=padding, stride=stride).to(input.dtype)
         return (input, )
 
     @classmethod
@@ -2187,20 +2314,10 @@ class Col2ImBackward0(FB):
         stride = grad_fn.__getattribute__('_saved_stride')
         dilation = grad_fn.__getattribute__('_saved_dilation')
 
-        _, channels, Hout, Wout = out.shape
-        dilated_h, dilated_w = [(k - 1) * d + 1 for k, d in zip(kernel_size, dilation)]
-        Hin, Win = [(i + 2 * pad - d) // s + 1 for i, pad, d, s in zip((Hout, Wout), padding, (dilated_h, dilated_w), stride)]
-        out_padding = torch.nn.functional.pad(out, (padding[0], padding[0], padding[1], padding[1]), value=0)
-        degree = cls.degree(Hin, Win, out, kernel_size, stride, padding, dilation)
-
-        indexing = lambda c, i, j: [slice(None), c, slice(i, Hin * stride[0] + i, stride[0]), slice(j, Win * stride[1] + j, stride[1])]
-        kqi_pad = torch.zeros_like(out_padding, device=Context.device[0])
-        index = 0
-        for c, i, j in itertools.product(range(channels), range(0, kernel_size[0] * dilation[0], dilation[0]), range(0, kernel_size[1] * dilation[1], dilation[1])):
-            kqi_pad[indexing(c, i, j)] += FB.temporary_KQI((out_padding / degree)[indexing(c, i, j)], input[:, index, :].reshape(-1, Hin, Win))
-        end = [None if padding[i] == 0 else -padding[i] for i in range(2)]
-        kqi_out = kqi_pad[[slice(None)] * 2 + [slice(padding[i], end[i]) for i in range(2)]].clone()
-
+        degree = cls.degree(input, out, kernel_size, stride, padding, dilation)
+        # Each column entry holds its share of the output it is summed into; padded entries hold 0 and so add no KQI.
+        kqi_in = FB.temporary_KQI(torch.nn.functional.unfold(out / degree, kernel_size, dilation=dilation, padding=padding, stride=stride), input)
+        kqi_out = torch.nn.functional.fold(kqi_in, out.shape[-2:], kernel_size, dilation=dilation, padding=padding, stride=stride)
         return (kqi_out, )
 
     @classmethod
@@ -2212,32 +2329,18 @@ class Col2ImBackward0(FB):
         stride = grad_fn.__getattribute__('_saved_stride')
         dilation = grad_fn.__getattribute__('_saved_dilation')
 
-        _, channels, Hout, Wout = out.shape
-        dilated_h, dilated_w = [(k - 1) * d + 1 for k, d in zip(kernel_size, dilation)]
-        Hin, Win = [(i + 2 * pad - d) // s + 1 for i, pad, d, s in zip((Hout, Wout), padding, (dilated_h, dilated_w), stride)]
-
-        out_padding = torch.nn.functional.pad(out, (padding[0], padding[0], padding[1], padding[1]), value=float('nan'))
-        indexing = lambda c, i, j: [slice(None), c, slice(i, Hin * stride[0] + i, stride[0]), slice(j, Win * stride[1] + j, stride[1])]
-
-        index = 0
+        out_padding = torch.nn.functional.pad(out, (padding[1], padding[1], padding[0], padding[0]), value=float('nan'))
         adj = defaultdict(list)
-        for c, i, j in itertools.product(range(channels), range(0, kernel_size[0] * dilation[0], dilation[0]), range(0, kernel_size[1] * dilation[1], dilation[1])):
-            for i, o in zip(torch.flatten(input[:, index, :]), torch.flatten(out_padding[indexing(c, i, j)])):
-                if o == o:
-                    adj[int(o)].append(int(i))
-            index += 1
+        for i, o in zip(torch.flatten(input), torch.flatten(torch.nn.functional.unfold(out_padding, kernel_size, dilation=dilation, stride=stride))):
+            if o == o:
+                adj[int(o)].append(int(i))
         return {k: tuple(v) for k, v in adj.items()}
 
     @classmethod
-    def degree(cls, Hin, Win, out, kernel_size, stride, padding, dilation):
-        indexing = lambda c, i, j: [slice(None), c, slice(i, Hin * stride[0] + i, stride[0]), slice(j, Win * stride[1] + j, stride[1])]
-        out_padding = torch.nn.functional.pad(out, (padding[0], padding[0], padding[1], padding[1]), value=0)
-        degree_pad = torch.zeros_like(out_padding, device=Context.device[0])
-        for c, i, j in itertools.product(range(out.shape[1]), range(0, kernel_size[0] * dilation[0], dilation[0]), range(0, kernel_size[1] * dilation[1], dilation[1])):
-            degree_pad[indexing(c, i, j)] += 1
-        end = [None if padding[i] == 0 else -padding[i] for i in range(2)]
-        degree = degree_pad[[slice(None)] * 2 + [slice(padding[i], end[i]) for i in range(2)]].clone()
-        return degree
+    @FB.structure_Caching
+    def degree(cls, input, out, kernel_size, stride, padding, dilation):
+        ones = torch.ones(input.shape, dtype=out.dtype, device=Context.device[0])
+        return torch.nn.functional.fold(ones, out.shape[-2:], kernel_size, dilation=dilation, padding=padding, stride=stride)
 
 
 class L1LossBackward0(FB):
@@ -2279,6 +2382,8 @@ class L1LossBackward0(FB):
 
 
 class IndexCopyBackward0(FB):
+    saved_values = ('_saved_index', )
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=2, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -2348,6 +2453,11 @@ class IndexCopyBackward0(FB):
 
 
 class PermuteBackward0(FB):
+    @classmethod
+    def layout(cls, grad_fn, volume: torch.Tensor) -> torch.Tensor:
+        dims = grad_fn.__getattribute__('_saved_dims')
+        return volume.permute(tuple(i for _, i in sorted(tuple((d, i) for i, d in enumerate(dims)))))
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -2375,6 +2485,8 @@ class PermuteBackward0(FB):
 
 
 class GatherBackward0(FB):
+    saved_values = ('_saved_index', )
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -2404,6 +2516,11 @@ class GatherBackward0(FB):
 
 
 class SqueezeBackward0(FB):
+    @classmethod
+    def layout(cls, grad_fn, volume: torch.Tensor) -> torch.Tensor:
+        (input, ) = grad_fn()
+        return volume.reshape(input.shape)
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -2430,6 +2547,8 @@ class SqueezeBackward0(FB):
 
 
 class IndexSelectBackward0(FB):
+    saved_values = ('_saved_index', )
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
@@ -2438,6 +2557,7 @@ class IndexSelectBackward0(FB):
         index = index.unsqueeze(0) if index.dim() == 0 else index
         dim = grad_fn.__getattribute__('_saved_dim')
         select_index = 1 + out
+        input = torch.zeros_like(input, device=Context.device[0])
         for num, i in enumerate(index):
             input.select(dim, i).copy_(select_index[num])
         return (input, )
@@ -2499,42 +2619,37 @@ class RollBackward0(FB):
 
 
 class IndexBackward0(FB):
+    saved_values = ('_saved_indices', )
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=1, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, ), (out, ) = grad_fn(), volume_outputs
-        indices = grad_fn.__getattribute__('_saved_indices')[0]
-        if indices.dtype == torch.bool:
-            indices = torch.nonzero(indices, as_tuple=True)[0]
-        input = torch.zeros_like(input, device=Context.device[0])
-        for i in range(len(indices)):
-            input[indices[i], :] = 1 + out[i, :]
+        indices = cls.indices(grad_fn, input)
+        input = torch.zeros_like(input, device=Context.device[0]).index_add_(0, indices, (1 + out).reshape((-1, ) + input.shape[1:]).to(input.dtype))
         return (input, )
 
     @classmethod
     @FB.cell_KQI_Checking(args_in=1, args_out=1)
     def cell_KQI(cls, grad_fn, volume_inputs: Tuple[torch.Tensor], volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, ), (out, ) = volume_inputs, volume_outputs
-        indices = grad_fn.__getattribute__('_saved_indices')[0]
-        if indices.dtype == torch.bool:
-            indices = torch.nonzero(indices, as_tuple=True)[0]
-        kqi_out = torch.zeros_like(out, device=Context.device[0])
-        for i in range(len(indices)):
-            kqi_out[i, :] = FB.temporary_KQI(out[i, :], input[indices[i], :])
+        kqi_out = FB.temporary_KQI(out, input.index_select(0, cls.indices(grad_fn, input)).reshape_as(out))
         return (kqi_out, )
 
     @classmethod
     @FB.cell_Graph_Checking(args_in=1, args_out=1)
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
         (input, ), (out, ) = inputs, outputs
+        adj = {int(o): (int(i), ) for i, o in zip(torch.flatten(input.index_select(0, cls.indices(grad_fn, input))), torch.flatten(out))}
+        return adj
+
+    @classmethod
+    def indices(cls, grad_fn, input):
+        # Flat, non-negative row indices into dim 0 of the input, in the order of the output rows.
         indices = grad_fn.__getattribute__('_saved_indices')[0]
         if indices.dtype == torch.bool:
             indices = torch.nonzero(indices, as_tuple=True)[0]
-        adj = defaultdict(list)
-        for k in range(len(indices)):
-            for i, o in zip(torch.flatten(input[indices[k], :]), torch.flatten(out[k, :])):
-                adj[int(o)].append(int(i))
-        return {k: tuple(v) for k, v in adj.items()}
+        return indices.flatten().to(Context.device[0]).remainder(input.shape[0])
 
 
 class Upsample2DBackward1(FB):
@@ -2558,12 +2673,9 @@ class Upsample2DBackward1(FB):
     @FB.cell_Graph_Checking(args_in=1, args_out=1)
     def cell_Graph(cls, grad_fn, inputs: Tuple[torch.Tensor], outputs: Tuple[torch.Tensor]) -> Dict[int, Tuple[int]]:
         (input, ), (out, ) = inputs, outputs
-        batch, channel = input.shape[:2]
-        adj = defaultdict(list)
-        for b, c in itertools.product(range(batch), range(channel)):
-            for i, o in itertools.product(torch.flatten(input[b, c]), torch.flatten(out[b, c])):
-                adj[int(o)].append(int(i))
-        return {k: tuple(v) for k, v in adj.items()}
+        out = out.flatten(2)
+        adj = FB.adjacency(out, input.flatten(2).unsqueeze(2).expand(*out.shape, -1))
+        return adj
 
 
 class UpsampleBilinear2DBackward0(Upsample2DBackward1):
@@ -2588,7 +2700,7 @@ class SplitWithSizesBackward0(FB):
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, ), outputs = grad_fn(), volume_outputs
         dim = grad_fn.__getattribute__('_saved_dim')
-        input = torch.zeros_like(input, device=Context.device[0]) + 1 + torch.cat(outputs, dim)
+        input = 1 + torch.cat(outputs, dim)
         return (input, )
 
     @classmethod
@@ -2610,15 +2722,20 @@ class SplitWithSizesBackward0(FB):
 
 
 class IndexPutBackward0(FB):
+    saved_values = ('_saved_indices', )
+
     @classmethod
     @FB.cell_Volume_Checking(args_in=2, args_out=1)
     def cell_Volume(cls, grad_fn, volume_outputs: Tuple[torch.Tensor]) -> Tuple[torch.Tensor]:
         (input, value), (out, ) = grad_fn(), volume_outputs
         indices = grad_fn.__getattribute__('_saved_indices')[0]
+        if value is not None:
+            value = torch.zeros_like(value, device=Context.device[0])
         if len(indices) == 0:
             input = 1 + out
         else:
             if input is not None:
+                input = torch.zeros_like(input, device=Context.device[0])
                 all_indices = torch.arange(input.shape[0])
                 remain_indices = [i for i in all_indices if i not in indices]
                 for i in remain_indices:
@@ -4,11 +4,17 @@ import numpy as np
 
 import logging
 import itertools
-from . import functions, function_base
-from typing import Tuple, Iterator, Union, Dict, Callable
+import asyncio
+import contextvars
+import threading
+from . import functions, function_base, cache, export
+from typing import Tuple, Iterator, AsyncIterator, Union, Dict, Callable
 from matplotlib import cm, colors, pyplot as plt
 
 
+logger = logging.getLogger(__name__)
+
+
 def __construct_compute_graph(grad_fn):
     G = nx.MultiDiGraph()
     stack = [grad_fn]
@@ -26,21 +32,93 @@ def __construct_compute_graph(grad_fn):
     return G
 
 
-__W = torch.tensor(0, dtype=float)
+def __one_to_one_chains(G: nx.MultiDiGraph) -> Dict[object, Tuple[object]]:
+    # Maximal chains c[0] <- c[1] <- ... <- c[-1] of one-to-one and view nodes in which every c[j + 1] feeds only c[j], and the input of c[-1] only c[-1], keyed by c[0].
+    def linkable(grad_fn):
+        func = functions.backward_mapper(grad_fn)
+        return func.layout is not None and func.nan_kqi == 'never' and len(grad_fn.next_functions) == 1 and grad_fn.next_functions[0][0] is not None
+
+    def member(grad_fn):
+        return G.out_degree(grad_fn) == 1 and linkable(grad_fn)
+
+    chains = {}
+    for head in G.nodes:
+        if not linkable(head) or (member(head) and linkable(next(G.successors(head)))):
+            continue
+        chain = [head]
+        while member(chain[-1].next_functions[0][0]):
+            chain.append(chain[-1].next_functions[0][0])
+        if G.out_degree(chain[-1].next_functions[0][0]) > 1:
+            chain.pop()  # Its input volume sums those of other consumers, so it takes the regular path
+        if chain:
+            chains[head] = tuple(chain)
+    return chains
+
+
+def __accumulate(volumes, next_fn, i: int, vI: torch.Tensor):
+    # One buffer per output slot, allocated on the first contribution and summed in place afterwards.
+    Vs = volumes.get(next_fn, tuple())
+    if len(Vs) <= i or not isinstance(Vs[i], torch.Tensor):
+        buffer = torch.zeros(function_base.Context.grad_fn_info[next_fn]['output'][i][0], dtype=vI.dtype, device=function_base.Context.device[0])
+        Vs = Vs[:i] + (0,) * (i - len(Vs)) + (buffer,) + Vs[i + 1:]
+    Vs[i].add_(vI)
+    volumes[next_fn] = Vs
+
+
+@torch.no_grad()
+def __compute_W(model_output: torch.Tensor, G: nx.MultiDiGraph, disk_cache_dir: str = None) -> torch.Tensor:
+    grad_fn = model_output.grad_fn
+    if disk_cache_dir is None:
+        volumes = {}  # Dict[torch.autograd.graph.Node, Tuple[torch.Tensor]]
+    else:
+        volumes = function_base.DiskDict(f'{disk_cache_dir}/W')
+    volumes[grad_fn] = (torch.zeros_like(model_output, device=function_base.Context.device[0]),)
+
+    chains = __one_to_one_chains(G)
+    fused = {grad_fn for chain in chains.values() for grad_fn in chain[1:]}
+
+    W = 0
+    for cur in reversed(list(nx.topological_sort(G))):
+        if cur in fused:
+            continue
+        func = functions.backward_mapper(cur)
+        if cur in chains:
+            next_fn, i = chains[cur][-1].next_functions[0]
+            volumes[next_fn] = (0,) * i + (functions.OnetoOneMapping.cell_Volume_chain(chains[cur], volumes[cur][0]),)
+            del volumes[cur]
+            continue
+        inputs = func.cell_Volume(cur, volumes[cur])
+        W += func.cell_W(cur, volumes[cur])
+        for (next_fn, i), vI in zip(cur.next_functions, inputs):
+            if next_fn is not None:
+                __accumulate(volumes, next_fn, i, vI)
+        del volumes[cur]
+    return torch.as_tensor(W, device='cpu')
 
 
 @torch.no_grad()
-def __intermediate_result_generator(model_output: torch.Tensor, return_graph: bool = False, disk_cache_dir: str = None) -> Union[Iterator[Tuple[object, Tuple[torch.Tensor], Tuple[torch.Tensor]]], Iterator[Tuple[object, Tuple[torch.Tensor], Tuple[torch.Tensor], Tuple[torch.Tensor], Dict[int, Tuple[int]]]]]:
+def __intermediate_result_generator(model_output: torch.Tensor, return_graph: bool = False, disk_cache_dir: str = None, reduce: bool = False) -> Union[Iterator[Tuple[object, Tuple[torch.Tensor], Tuple[torch.Tensor]]], Iterator[Tuple[object, Tuple[torch.Tensor], Tuple[torch.Tensor], Tuple[torch.Tensor], Dict[int, Tuple[int]]]]]:
     grad_fn = model_output.grad_fn
     G = __construct_compute_graph(grad_fn)
 
+    # W is known before any KQI is computed, so the NaN placeholders of leaves are filled in as soon as they appear.
+    function_base.Context.W = __compute_W(model_output, G, disk_cache_dir)
+    W = function_base.Context.W.to(function_base.Context.device[0])
+
+    def finalize(func, kqis, vols):
+        if func.nan_kqi == 'always':
+            return tuple(functions.FB.temporary_KQI(vol, W) for vol in vols)
+        if func.nan_kqi == 'partial':
+            for kqi, vol in zip(kqis, vols):
+                mask = kqi.isnan()
+                kqi[mask] = functions.FB.temporary_KQI(vol[mask], W)
+        return kqis
+
     if disk_cache_dir is None:
-        volumes = {grad_fn: (torch.zeros_like(model_output),)}  # Dict[torch.autograd.graph.Node, Tuple[torch.Tensor]]
-        pending = {}
+        volumes = {}  # Dict[torch.autograd.graph.Node, Tuple[torch.Tensor]]
     else:
         volumes = function_base.DiskDict(f'{disk_cache_dir}/volumes')
-        pending = function_base.DiskDict(f'{disk_cache_dir}/pending')
-    volumes[grad_fn] = (torch.zeros_like(model_output),)
+    volumes[grad_fn] = (torch.zeros_like(model_output, device=function_base.Context.device[0]),)
     waiting = {}  # Dict[torch.autograd.graph.Node, int]
     garbage_counter = {}  # Dict[torch.autograd.graph.Node, int]
     if return_graph:
@@ -48,32 +126,43 @@ def __intermediate_result_generator(model_output: torch.Tensor, return_graph: bo
         nodeIDs = {grad_fn: (torch.arange(increID, increID + model_output.numel(), dtype=torch.float64).reshape_as(model_output),)}  # Dict[torch.autograd.graph.Node, Tuple[torch.Tensor]]
         increID += model_output.numel()
 
+    # Chains of one-to-one and view nodes walk the output volume of their first node in place into the input volume of their last one,
+    # which becomes the volume of the producer feeding only the chain. Their KQIs are computed as they are yielded, after the consumers of the first node,
+    # so the volumes yielded for a chain are views of a buffer that is advanced afterwards.
+    chains = {} if return_graph else __one_to_one_chains(G)
+    fused = {grad_fn for chain in chains.values() for grad_fn in chain[1:]}
+    finished = set()  # Last nodes of chains, computed before their input is
+
     for cur in reversed(list(nx.topological_sort(G))):
+        if cur in fused:
+            continue
         garbage_counter[cur] = G.out_degree(cur) + G.in_degree(cur)
-        inputs = functions.backward_mapper(cur).cell_Volume(cur, volumes[cur])
+        inputs = () if cur in chains else functions.backward_mapper(cur).cell_Volume(cur, volumes[cur])
         for (next_fn, i), vI in zip(cur.next_functions, inputs):
             if next_fn is not None:
                 waiting[cur] = waiting.get(cur, 0) + 1
-                volumes[next_fn] = tuple(v_old + vI for v_old, vI in itertools.zip_longest(volumes.get(next_fn, tuple()), (0,) * i + (vI,), fillvalue=0))
+                __accumulate(volumes, next_fn, i, vI)
                 if return_graph:
                     nodeIDs[next_fn] = tuple(v_old if v_old is not None or vI is None else torch.arange(increID, increID + vI.numel(), dtype=torch.float64).reshape_as(vI) for v_old, vI in itertools.zip_longest(nodeIDs.get(next_fn, tuple()), (None,) * i + (vI,), fillvalue=None))
                     if any(nodeID is not None and nodeID.eq(increID).any() for nodeID in nodeIDs[next_fn]):
                         increID += vI.numel()
 
         for _, succ in G.out_edges(cur):
+            if succ in finished:
+                finished.remove(succ)
+                garbage_counter[cur] -= 1
+                continue
             waiting[succ] -= 1
             if waiting[succ] == 0:
-                kqis = functions.backward_mapper(succ).cell_KQI(succ, tuple(volumes[next_fn][i] if next_fn is not None else None for next_fn, i in succ.next_functions), volumes[succ])
-                if any(kqi.isnan().any() for kqi in kqis):
-                    if return_graph:
-                        pending[succ] = (kqis, volumes[succ], nodeIDs[succ], functions.backward_mapper(succ).cell_Graph(succ, tuple(nodeIDs[next_fn][i] if next_fn is not None else None for next_fn, i in succ.next_functions), nodeIDs[succ]))
-                    else:
-                        pending[succ] = (kqis, volumes[succ])
+                func, volume_inputs = functions.backward_mapper(succ), tuple(volumes[next_fn][i] if next_fn is not None else None for next_fn, i in succ.next_functions)
+                if reduce and func.cell_KQI_sum is not None:
+                    kqis = (func.cell_KQI_sum(succ, volume_inputs, volumes[succ]),)
                 else:
-                    if return_graph:
-                        yield succ, kqis, volumes[succ], nodeIDs[succ], functions.backward_mapper(succ).cell_Graph(succ, tuple(nodeIDs[next_fn][i] if next_fn is not None else None for next_fn, i in succ.next_functions), nodeIDs[succ])
-                    else:
-                        yield succ, kqis, volumes[succ]
+                    kqis = finalize(func, func.cell_KQI(succ, volume_inputs, volumes[succ]), volumes[succ])
+                if return_graph:
+                    yield succ, kqis, volumes[succ], nodeIDs[succ], func.cell_Graph(succ, tuple(nodeIDs[next_fn][i] if next_fn is not None else None for next_fn, i in succ.next_functions), nodeIDs[succ])
+                else:
+                    yield succ, kqis, volumes[succ]
                 del waiting[succ]
                 for pred, _ in G.in_edges(succ):
                     garbage_counter[succ] -= 1
@@ -89,26 +178,79 @@ def __intermediate_result_generator(model_output: torch.Tensor, return_graph: bo
                     if return_graph:
                         del nodeIDs[succ]
 
+        if cur in chains:
+            chain, func = chains[cur], functions.OnetoOneMapping
+            volume = volumes[cur][0]
+            if garbage_counter[cur] > G.in_degree(cur):
+                volume = volume.clone()  # Consumers of cur waiting on other inputs still read its volume
+            for succ, (kqi, volume) in zip(chain, func.cell_KQI_chain(chain, volume)):
+                yield succ, (kqi,), (volume,)
+            next_fn, i = chain[-1].next_functions[0]
+            volumes[next_fn] = (0,) * i + (func.cell_Volume_chain(chain[-1:], volume),)
+            finished.add(chain[-1])
+            garbage_counter[cur] -= 1
+            if garbage_counter[cur] == 0:
+                del volumes[cur]
+                del garbage_counter[cur]
+
     for grad_fn, Vs in volumes.items():
-        kqis = functions.backward_mapper(grad_fn).cell_KQI(grad_fn, (), Vs)
-        if any(kqi.isnan().any() for kqi in kqis):
-            if return_graph:
-                pending[grad_fn] = (kqis, Vs, nodeIDs[grad_fn], functions.backward_mapper(grad_fn).cell_Graph(grad_fn, tuple(), nodeIDs[grad_fn]))
-            else:
-                pending[grad_fn] = (kqis, Vs)
+        func = functions.backward_mapper(grad_fn)
+        kqis = finalize(func, func.cell_KQI(grad_fn, (), Vs), Vs)
+        if return_graph:
+            yield grad_fn, kqis, Vs, nodeIDs[grad_fn], func.cell_Graph(grad_fn, tuple(), nodeIDs[grad_fn])
         else:
-            if return_graph:
-                yield grad_fn, kqis, Vs, nodeIDs[grad_fn], functions.backward_mapper(grad_fn).cell_Graph(grad_fn, tuple(), nodeIDs[grad_fn])
-            else:
-                yield grad_fn, kqis, Vs
-
-    global __W
-    __W = sum(K.isnan().sum() + V.masked_select(K.isnan()).sum() for _, (Ks, Vs, *_) in pending.items() for K, V in zip(Ks, Vs))
-    for grad_fn, (kqis, vols, *args) in pending.items():
-        yield grad_fn, tuple(kqi.masked_scatter(kqi.isnan(), torch.masked_select(functions.FB.temporary_KQI(vol, __W), kqi.isnan())) for kqi, vol in zip(kqis, vols)), vols, *args
-
-
-def __prepare(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable, device: Union[torch.device, Tuple[torch.device]]) -> torch.Tensor:
+            yield grad_fn, kqis, Vs
+
+    function_base.Context.emit(event='finish', W=float(function_base.Context.W), structure_cache=function_base.Context.structures.info())
+
+
+def __tensors(value) -> Iterator[torch.Tensor]:
+    if isinstance(value, torch.Tensor):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            yield from __tensors(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from __tensors(v)
+
+
+def __module_hooks(model: torch.nn.Module, modules: Dict[object, str]) -> list:
+    '''
+    Forward hooks recording in modules the path of the innermost module whose forward created each autograd node.
+    Submodules return before their parent, so walking back from a module's outputs to the nodes of its inputs finds its own nodes unrecorded,
+    and skips over those of a submodule call straight to the inputs of that call.
+    Parameters are left out and attributed by their names.
+    '''
+    inputs, bounds = [], {}
+
+    def pre_hook(module, args, kwargs):
+        inputs.append({tensor.grad_fn for tensor in __tensors((args, kwargs)) if tensor.grad_fn is not None})
+
+    def hook_factory(path):
+        def hook(module, args, kwargs, output):
+            stop, seen = inputs.pop(), set()
+            stack = [tensor.grad_fn for tensor in __tensors(output)]
+            while stack:
+                grad_fn = stack.pop()
+                if grad_fn is None or grad_fn in seen or grad_fn in stop or 'AccumulateGrad' in grad_fn.name():
+                    continue
+                seen.add(grad_fn)
+                if grad_fn in modules:
+                    stack.extend(bounds[grad_fn])
+                    continue
+                modules[grad_fn], bounds[grad_fn] = path, stop
+                stack.extend(next_fn for next_fn, _ in grad_fn.next_functions)
+        return hook
+
+    handles = []
+    for path, module in model.named_modules():
+        handles.append(module.register_forward_pre_hook(pre_hook, with_kwargs=True))
+        handles.append(module.register_forward_hook(hook_factory(path), with_kwargs=True))
+    return handles
+
+
+def __prepare(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable, device: Union[torch.device, Tuple[torch.device]], fast: bool = False, progress: Callable[[int, int], None] = None, events: Callable[[dict], None] = None, memory_budget: int = None) -> torch.Tensor:
     try:
         torch.backends.cuda.enable_flash_sdp(False)
         torch.backends.cuda.enable_mem_efficient_sdp(False)
@@ -120,54 +262,269 @@ def __prepare(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable,
     except Exception:
         pass
 
-    model.eval()
-    callback_func(model, x)  # Initialize the lazy model if any
+    with function_base.Context.model_lock(model):
+        model.eval()
+        callback_func(model, x)  # Initialize the lazy model if any
 
-    model.requires_grad_(True)
-    if isinstance(x, dict):
-        for key, tensor in x.items():
-            tensor.requires_grad_(False)
-    else:
-        x.requires_grad_(False)
-    model_output = callback_func(model, x)
+        model.requires_grad_(True)
+        if isinstance(x, dict):
+            for key, tensor in x.items():
+                tensor.requires_grad_(False)
+        else:
+            x.requires_grad_(False)
+        modules = {}
+        handles = __module_hooks(model, modules)
+        try:
+            model_output = callback_func(model, x)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        G = __construct_compute_graph(model_output.grad_fn)
+        function_base.Context.init(model.__class__.__name__, G.number_of_nodes() * 3, [device] if isinstance(device, torch.device) else device, fast, progress, events, memory_budget)
+        function_base.Context.modules = modules
+
+        handles = [grad_fn.register_hook(function_base.Context.hook_factory(grad_fn)) for grad_fn in G.nodes]
+        try:
+            model_output.backward(model_output, retain_graph=True)
+        finally:
+            for handle in handles:
+                handle.remove()
+        model.zero_grad()
+    return model_output
 
-    G = __construct_compute_graph(model_output.grad_fn)
-    function_base.Context.init(model.__class__.__name__, G.number_of_nodes() * 2, [device] if isinstance(device, torch.device) else device)
 
-    for grad_fn in G.nodes:
-        grad_fn.register_hook(function_base.Context.hook_factory(grad_fn))
-    model_output.backward(model_output, retain_graph=True)
-    model.zero_grad()
-    return model_output
+def __breakdown(model: torch.nn.Module, model_output: torch.Tensor, disk_cache_dir: str = None, parameter_tensors: bool = False) -> dict:
+    model_params = {var: name for name, var in model.named_parameters()}
+    kqi = torch.tensor(0, dtype=float, device=function_base.Context.device[0])
+    ops, parameters, modules, tensors = {}, {}, {}, {}
+    for grad_fn, ks, vs in __intermediate_result_generator(model_output, disk_cache_dir=disk_cache_dir, reduce=True):
+        k = sum(map(lambda k: k.sum(), ks))
+        kqi += k
+        op = ops.setdefault(grad_fn.name(), [0, 0, 0])
+        op[0] += k
+        op[1] += sum(v.numel() for v in vs if isinstance(v, torch.Tensor))
+        op[2] += 1
+        if 'AccumulateGrad' in grad_fn.name() and grad_fn.variable in model_params:
+            parameters[model_params[grad_fn.variable]] = k
+            if parameter_tensors:
+                tensors[model_params[grad_fn.variable]] = function_base.Context.to_host(ks[0]).cpu()
+            path = model_params[grad_fn.variable].rpartition('.')[0]
+        else:
+            path = function_base.Context.modules.get(grad_fn, '')
+        modules[path] = modules.get(path, 0) + k
+    W = float(function_base.Context.W)
+
+    # Each module's KQI includes that of its submodules; 'self' is the part of its own nodes.
+    hierarchy = {}
+    for path, k in modules.items():
+        names = path.split('.') if path else []
+        for depth in range(len(names) + 1):
+            hierarchy.setdefault('.'.join(names[:depth]), [0, 0])[0] += k
+        hierarchy[path][1] += k
+    result = {'kqi': float(kqi.cpu() / function_base.Context.W), 'W': W,
+              'ops': {name: {'kqi': float(k) / W, 'numel': int(numel), 'count': count} for name, (k, numel, count) in ops.items()},
+              'parameters': {name: float(k) / W for name, k in parameters.items()},
+              'modules': {path: {'kqi': float(k) / W, 'self': float(own) / W} for path, (k, own) in sorted(hierarchy.items())}}
+    if parameter_tensors:
+        result['tensors'] = {name: tensor / W for name, tensor in tensors.items()}
+    return result
+
+
+def __cached_breakdown(model: torch.nn.Module, model_output: torch.Tensor, disk_cache_dir: str = None, cache_dir: str = None, parameter_tensors: bool = False, key: str = None) -> dict:
+    if cache_dir is None:
+        return __breakdown(model, model_output, disk_cache_dir, parameter_tensors)
+    results, key = cache.ResultCache(cache_dir), key if key is not None else cache.signature(model_output.grad_fn)
+    result = results.load(key)
+    tensors = results.load_tensors(key) if parameter_tensors and result is not None else None
+    if result is None or (parameter_tensors and tensors is None):
+        # Results stored without tensors are computed again when the tensors are asked for.
+        result = __breakdown(model, model_output, disk_cache_dir, parameter_tensors)
+        tensors = result.pop('tensors', None)
+        results.store(key, result, tensors)
+    else:
+        function_base.Context.emit(event='finish', W=result['W'], cached=True)
+    logger.debug('W = %s, KQI = %s (signature %s)', result['W'], result['kqi'], key)
+    return dict(result, tensors=tensors) if parameter_tensors else result
 
 
-def KQI(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None) -> torch.Tensor:
-    model_output = __prepare(model, x, callback_func, device)
+@function_base.isolated
+def KQI(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None, fast: bool = False, progress: Callable[[int, int], None] = None, events: Callable[[dict], None] = None, cache_dir: str = None, memory_budget: int = None) -> torch.Tensor:
+    model_output = __prepare(model, x, callback_func, device, fast, progress, events, memory_budget)
 
-    kqi = torch.tensor(0, dtype=float)
-    for _, ks, _ in __intermediate_result_generator(model_output, disk_cache_dir=disk_cache_dir):
+    if cache_dir is not None:
+        return torch.tensor(__cached_breakdown(model, model_output, disk_cache_dir, cache_dir)['kqi'], dtype=float)
+
+    kqi = torch.tensor(0, dtype=float, device=function_base.Context.device[0])
+    for _, ks, _ in __intermediate_result_generator(model_output, disk_cache_dir=disk_cache_dir, reduce=True):
         kqi += sum(map(lambda k: k.sum(), ks))
-    kqi /= __W
-    logging.debug(f'W = {__W}, KQI = {kqi}')
+    kqi = kqi.cpu() / function_base.Context.W
+    logger.debug('W = %s, KQI = %s', function_base.Context.W, kqi)
     return kqi
 
 
-def Graph(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None) -> Iterator[Tuple[int, Tuple[int], str, float, float]]:
-    model_output = __prepare(model, x, callback_func, device)
+@function_base.isolated
+def KQI_breakdown(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None, fast: bool = False, progress: Callable[[int, int], None] = None, events: Callable[[dict], None] = None, cache_dir: str = None, memory_budget: int = None, parameter_tensors: bool = False) -> dict:
+    '''
+    Total KQI with its per-op and per-parameter shares, from a single traversal.
+    Returns {'kqi', 'W', 'ops': {name: {'kqi', 'numel', 'count'}}, 'parameters': {name: kqi}, 'modules': {path: {'kqi', 'self'}}}, where the shares sum to 'kqi'.
+    Nodes are attributed to the innermost module whose forward created them, and parameters to the module owning them; the model itself is ''.
+    With parameter_tensors, 'tensors': {name: tensor} adds the per-element KQI of each parameter, also kept in cache_dir.
+    '''
+    model_output = __prepare(model, x, callback_func, device, fast, progress, events, memory_budget)
+    return __cached_breakdown(model, model_output, disk_cache_dir, cache_dir, parameter_tensors)
+
+
+@function_base.isolated
+def prepare(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), fast: bool = False, memory_budget: int = None) -> Tuple[function_base.Session, torch.Tensor, str]:
+    '''
+    Trace model on x once, for prepared_breakdown to compute from as often as needed.
+    Returns the session holding the graph's grad_fn_info, the model output, and the graph signature under which cache_dir keeps its results.
+    '''
+    model_output = __prepare(model, x, callback_func, device, fast, memory_budget=memory_budget)
+    return function_base.session.get(), model_output, cache.signature(model_output.grad_fn)
+
+
+def prepared_breakdown(model: torch.nn.Module, prepared: Tuple[function_base.Session, torch.Tensor, str], cache_dir: str = None, parameter_tensors: bool = False) -> dict:
+    '''
+    KQI_breakdown of a graph traced by prepare, without running the model again. Runs on the same prepared graph must not overlap.
+    '''
+    session, model_output, key = prepared
+    context = contextvars.copy_context()
+    context.run(function_base.session.set, session)
+    return context.run(__cached_breakdown, model, model_output, None, cache_dir, parameter_tensors, key)
+
+
+@function_base.isolated
+def Graph(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None, fast: bool = False, progress: Callable[[int, int], None] = None, events: Callable[[dict], None] = None, memory_budget: int = None) -> Iterator[Tuple[int, Tuple[int], str, float, float]]:
+    model_output = __prepare(model, x, callback_func, device, fast, progress, events, memory_budget)
 
     for grad_fn, kqis, volumes, node_ids, adj in __intermediate_result_generator(model_output, return_graph=True, disk_cache_dir=disk_cache_dir):
+        kqis, volumes, W = *function_base.Context.to_host((kqis, volumes)), function_base.Context.W
         for kqi, volume, node_id in zip(kqis, volumes, node_ids):
             for k, v, i in zip(kqi.flatten(), volume.flatten(), node_id.flatten()):
-                yield int(i), adj[int(i)], grad_fn.name(), float(k / __W), float(v)
+                yield int(i), adj[int(i)], grad_fn.name(), float(k / W), float(v)
+
+
+@function_base.isolated
+def export_graph(model: torch.nn.Module, x: torch.Tensor, path: str, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None, fast: bool = False, progress: Callable[[int, int], None] = None, events: Callable[[dict], None] = None, memory_budget: int = None, shard_size: int = 1 << 20) -> dict:
+    '''
+    Write the element graph of Graph to path as NPY shards of nodes (id, op, kqi, volume) and edges (src, dst), flushed as the traversal goes.
+    Read it back with load_graph.
+    '''
+    model_output = __prepare(model, x, callback_func, device, fast, progress, events, memory_budget)
+    writer = export.GraphWriter(path, shard_size)
+    for grad_fn, kqis, volumes, node_ids, adj in __intermediate_result_generator(model_output, return_graph=True, disk_cache_dir=disk_cache_dir):
+        kqis, volumes = function_base.Context.to_host((kqis, volumes))
+        writer.add(grad_fn.name(), node_ids, tuple(k / function_base.Context.W for k in kqis), volumes, adj)
+    return writer.close(W=float(function_base.Context.W))
 
 
-def KQI_generator(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None) -> Iterator[Tuple[object, Tuple[torch.Tensor]]]:
-    model_output = __prepare(model, x, callback_func, device)
+@function_base.isolated
+def KQI_generator(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None, fast: bool = False, progress: Callable[[int, int], None] = None, events: Callable[[dict], None] = None, memory_budget: int = None) -> Iterator[Tuple[object, Tuple[torch.Tensor]]]:
+    model_output = __prepare(model, x, callback_func, device, fast, progress, events, memory_budget)
     for grad_fn, ks, _ in __intermediate_result_generator(model_output, disk_cache_dir=disk_cache_dir):
-        yield grad_fn, tuple(k / __W for k in ks)
+        yield grad_fn, tuple(k / function_base.Context.W for k in function_base.Context.to_host(ks))
 
 
-def VisualKQI(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None, filename: str = None, dots_per_unit: int = 4, fontsize=7):
+def __selection_kqis(model: torch.nn.Module, x: torch.Tensor, params_only: bool, *args) -> Iterator[Tuple[str, torch.Tensor]]:
+    model_params = {var: name for name, var in model.named_parameters()}
+    for index, (grad_fn, kqis) in enumerate(KQI_generator(model, x, *args)):
+        if 'AccumulateGrad' in grad_fn.name() and grad_fn.variable in model_params:
+            yield model_params[grad_fn.variable], kqis[0]
+        elif not params_only:
+            for i, kqi in enumerate(kqis):
+                yield f'{grad_fn.name()}#{index}.{i}', kqi
+
+
+async def KQI_generator_async(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None, fast: bool = False, progress: Callable[[int, int], None] = None, events: Callable[[dict], None] = None, memory_budget: int = None, maxsize: int = 16) -> AsyncIterator[Tuple[object, Tuple[torch.Tensor]]]:
+    '''
+    KQI_generator for asyncio. The engine runs on a worker thread and hands its results over through a queue of at most maxsize items,
+    pausing while the queue is full. progress and events are called on the event loop.
+    Leaving the loop early or cancelling stops the engine after the cell in progress, which frees its volumes and disk caches.
+    '''
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize)
+    stop = threading.Event()
+    finished = object()
+
+    def on_loop(callback):
+        return None if callback is None else lambda *args: loop.call_soon_threadsafe(callback, *args)
+
+    def put(item, err=None):
+        if not stop.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put((item, err)), loop).result()
+
+    def worker():
+        generator = KQI_generator(model, x, callback_func, device, disk_cache_dir, fast, on_loop(progress), on_loop(events), memory_budget)
+        try:
+            for item in generator:
+                if stop.is_set():
+                    return
+                put(item)
+        except Exception as err:
+            return put(None, err)
+        finally:
+            generator.close()
+        put(finished)
+
+    future = loop.run_in_executor(None, worker)
+    try:
+        while True:
+            item, err = await queue.get()
+            if err is not None:
+                raise err
+            if item is finished:
+                break
+            yield item
+    finally:
+        stop.set()
+        while not queue.empty():
+            queue.get_nowait()
+        await future
+
+
+@function_base.isolated
+def topk(model: torch.nn.Module, x: torch.Tensor, k: int, largest: bool = True, params_only: bool = True, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None, fast: bool = False, progress: Callable[[int, int], None] = None, events: Callable[[dict], None] = None, memory_budget: int = None, return_values: bool = False) -> Union[Dict[str, torch.Tensor], Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]]:
+    '''
+    Masks of the k elements with the largest (or smallest) KQI, keyed by parameter name.
+    With params_only=False the other nodes are ranked too, keyed by '{op}#{node}.{output}' in traversal order.
+    Only the best candidates seen so far are kept during the traversal, so memory is bounded by k rather than by the model.
+    With return_values=True, the KQIs of the selected elements are returned too, keyed like the masks and ordered like kqi[mask].
+    '''
+    shapes = {}
+    values, owners, indices = torch.empty(0), torch.empty(0, dtype=torch.int32), torch.empty(0, dtype=torch.int64)
+    for key, kqi in __selection_kqis(model, x, params_only, callback_func, device, disk_cache_dir, fast, progress, events, memory_budget):
+        values = torch.cat((values, kqi.flatten()))
+        owners = torch.cat((owners, torch.full((kqi.numel(), ), len(shapes), dtype=torch.int32)))
+        indices = torch.cat((indices, torch.arange(kqi.numel())))
+        shapes[key] = kqi.shape
+        if len(values) >= 2 * k:
+            values, best = values.topk(k, largest=largest, sorted=False)
+            owners, indices = owners[best], indices[best]
+    values, best = values.topk(min(k, len(values)), largest=largest, sorted=False)
+    owners, indices = owners[best], indices[best]
+
+    masks, kqis = {}, {}
+    for owner, (key, shape) in enumerate(shapes.items()):
+        selected, order = indices[owners == owner].sort()
+        mask = masks[key] = torch.zeros(shape, dtype=torch.bool)
+        mask.view(-1)[selected] = True
+        kqis[key] = values[owners == owner][order]
+    return (masks, kqis) if return_values else masks
+
+
+@function_base.isolated
+def threshold(model: torch.nn.Module, x: torch.Tensor, value: float, above: bool = True, params_only: bool = True, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None, fast: bool = False, progress: Callable[[int, int], None] = None, events: Callable[[dict], None] = None, memory_budget: int = None) -> Dict[str, torch.Tensor]:
+    '''
+    Masks of the elements whose KQI is at least (or, with above=False, at most) value, keyed like topk.
+    '''
+    return {key: kqi >= value if above else kqi <= value
+            for key, kqi in __selection_kqis(model, x, params_only, callback_func, device, disk_cache_dir, fast, progress, events, memory_budget)}
+
+
+@function_base.isolated
+def VisualKQI(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable = lambda model, x: model(x), device: Union[torch.device, Tuple[torch.device]] = torch.device('cpu'), disk_cache_dir: str = None, filename: str = None, dots_per_unit: int = 4, fontsize=7, fast: bool = False, progress: Callable[[int, int], None] = None, events: Callable[[dict], None] = None, memory_budget: int = None):
     plt.rcParams['figure.autolayout'] = False
     plt.rcParams['axes.spines.left'] = False
     plt.rcParams['axes.spines.bottom'] = False
@@ -213,10 +570,11 @@ def VisualKQI(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable =
             return model_params[grad_fn.variable]
         return grad_fn.name()
 
-    model_output = __prepare(model, x, callback_func, device)
+    model_output = __prepare(model, x, callback_func, device, fast, progress, events, memory_budget)
     G = __construct_compute_graph(model_output.grad_fn)
     kqi_min, kqi_max = np.inf, -np.inf
     for grad_fn, kqis, _ in __intermediate_result_generator(model_output, disk_cache_dir=disk_cache_dir):
+        kqis = function_base.Context.to_host(kqis)
         kqis_compact = [compact_to_2d(kqi) for kqi in kqis]
         G.nodes[grad_fn]['width'] = (sum(map(lambda k: k.shape[1], kqis_compact)) + INTERVAL * (len(kqis_compact) - 1) + PADDING * 2) / SCALE_INCH_PT
         G.nodes[grad_fn]['height'] = (max(map(lambda k: k.shape[0], kqis_compact)) + PADDING * 2) / SCALE_INCH_PT
@@ -242,6 +600,7 @@ def VisualKQI(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable =
     plt.ylim(0, 1)
 
     for grad_fn, kqis, _ in __intermediate_result_generator(model_output, disk_cache_dir=disk_cache_dir):
+        kqis = function_base.Context.to_host(kqis)
         plt.axes([posx_transform(pos[grad_fn][0] - G.nodes[grad_fn]['width'] * SCALE_INCH_PT / 2 + PADDING),
                   posy_transform(pos[grad_fn][1] - G.nodes[grad_fn]['height'] * SCALE_INCH_PT / 2 + PADDING),
                   posx_transform(G.nodes[grad_fn]['width'] * SCALE_INCH_PT - PADDING * 2 + x_min),
@@ -258,7 +617,7 @@ def VisualKQI(model: torch.nn.Module, x: torch.Tensor, callback_func: Callable =
             plt.title("$\\times$".join(map(str, kqi.shape)), pad=3, bbox=dict(facecolor='white', linewidth=0, boxstyle='Square, pad=0'))
             offset += kqi_compact.shape[1] + INTERVAL
 
-    plt.colorbar(cm.ScalarMappable(norm=colors.Normalize(vmin=kqi_min / __W, vmax=kqi_max / __W), cmap='turbo'), cax=plt.axes([0, -20 / (y_max - y_min), 1, 10 / (y_max - y_min)]), orientation='horizontal', fraction=1)
+    plt.colorbar(cm.ScalarMappable(norm=colors.Normalize(vmin=kqi_min / function_base.Context.W, vmax=kqi_max / function_base.Context.W), cmap='turbo'), cax=plt.axes([0, -20 / (y_max - y_min), 1, 10 / (y_max - y_min)]), orientation='horizontal', fraction=1)
     plt.xlabel('KQI')
 
     if filename is None:
@@ -0,0 +1,129 @@
+import torch
+import math
+from typing import Dict, Iterable, Tuple
+
+
+class LogHistogram:
+    '''
+    Histogram over log2-spaced bins fixed by (bins_per_octave, min_exp, max_exp), so histograms of separate runs merge by adding counts.
+    Positive values below 2 ** min_exp fall in the first bin, and values from 2 ** max_exp on in the last one.
+    Zeros, negative values and NaN are counted apart, below the first bin, and their quantiles are reported as 0 within the observed range.
+    '''
+    def __init__(self, bins_per_octave: int = 8, min_exp: int = -128, max_exp: int = 32):
+        self.bins_per_octave, self.min_exp, self.max_exp = bins_per_octave, min_exp, max_exp
+        self.counts = torch.zeros((max_exp - min_exp) * bins_per_octave + 2, dtype=torch.int64)
+        self.nonpositive = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values: torch.Tensor):
+        values = values.detach().flatten().double().cpu()
+        if values.numel() == 0:
+            return
+        positive = values[values > 0]
+        bins = ((positive.log2() - self.min_exp) * self.bins_per_octave).floor_().add_(1).nan_to_num_(0, posinf=len(self.counts) - 1)
+        self.counts += torch.bincount(bins.clamp_(0, len(self.counts) - 1).long(), minlength=len(self.counts))
+        self.nonpositive += values.numel() - positive.numel()
+        self.count += values.numel()
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other: 'LogHistogram') -> 'LogHistogram':
+        if (self.bins_per_octave, self.min_exp, self.max_exp) != (other.bins_per_octave, other.min_exp, other.max_exp):
+            raise ValueError('Cannot merge histograms with different bins.')
+        self.counts += other.counts
+        self.nonpositive += other.nonpositive
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q: float) -> float:
+        '''
+        Geometric middle of the bin holding the q-quantile, clamped to the observed range; off by at most a factor 2 ** (1 / bins_per_octave).
+        '''
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1) - self.nonpositive
+        if rank < 0:
+            return min(max(0.0, self.min), self.max)
+        b = int(torch.searchsorted(self.counts.cumsum(0), rank, side='right'))
+        if b == 0:
+            return max(self.min, 0.0)
+        if b == len(self.counts) - 1:
+            return self.max
+        return min(max(2 ** (self.min_exp + (b - 0.5) / self.bins_per_octave), self.min), self.max)
+
+    def summary(self, quantiles: Tuple[float] = (0.5, 0.9, 0.99)) -> dict:
+        return dict({'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max},
+                    **{f'p{round(q * 100, 2):g}': self.quantile(q) for q in quantiles})
+
+    def to_dict(self) -> dict:
+        nonzero = self.counts.nonzero().flatten()
+        return {'bins_per_octave': self.bins_per_octave, 'min_exp': self.min_exp, 'max_exp': self.max_exp,
+                'bins': nonzero.tolist(), 'counts': self.counts[nonzero].tolist(), 'nonpositive': self.nonpositive,
+                'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max}
+
+    @staticmethod
+    def from_dict(state: dict) -> 'LogHistogram':
+        histogram = LogHistogram(state['bins_per_octave'], state['min_exp'], state['max_exp'])
+        histogram.counts[state['bins']] = torch.tensor(state['counts'], dtype=torch.int64)
+        histogram.nonpositive = state.get('nonpositive', 0)
+        histogram.count, histogram.sum, histogram.min, histogram.max = state['count'], state['sum'], state['min'], state['max']
+        return histogram
+
+
+class KQISketch:
+    '''
+    Aggregation sink for KQI_generator keeping a LogHistogram of per-element KQI per op type and per parameter, instead of the tensors.
+    Sketches are JSON-serializable through to_dict, and those of sharded or parallel runs combine with merge.
+    '''
+    def __init__(self, bins_per_octave: int = 8, min_exp: int = -128, max_exp: int = 32):
+        self.bins = (bins_per_octave, min_exp, max_exp)
+        self.ops: Dict[str, LogHistogram] = {}
+        self.parameters: Dict[str, LogHistogram] = {}
+
+    def update(self, op: str, kqis: Iterable[torch.Tensor], parameter: str = None):
+        for kqi in kqis:
+            self.ops.setdefault(op, LogHistogram(*self.bins)).add(kqi)
+            if parameter is not None:
+                self.parameters.setdefault(parameter, LogHistogram(*self.bins)).add(kqi)
+
+    def consume(self, generator: Iterable[Tuple[object, Tuple[torch.Tensor]]], model: torch.nn.Module = None) -> 'KQISketch':
+        '''
+        Drain a KQI_generator. Pass the model to also sketch each parameter by name.
+        '''
+        model_params = {var: name for name, var in model.named_parameters()} if model is not None else {}
+        for grad_fn, kqis in generator:
+            parameter = model_params.get(grad_fn.variable) if 'AccumulateGrad' in grad_fn.name() else None
+            self.update(grad_fn.name(), kqis, parameter)
+        return self
+
+    def merge(self, other: 'KQISketch') -> 'KQISketch':
+        for mine, theirs in ((self.ops, other.ops), (self.parameters, other.parameters)):
+            for key, histogram in theirs.items():
+                if key in mine:
+                    mine[key].merge(histogram)
+                else:
+                    mine[key] = LogHistogram.from_dict(histogram.to_dict())
+        return self
+
+    def summary(self, quantiles: Tuple[float] = (0.5, 0.9, 0.99)) -> dict:
+        return {'ops': {key: histogram.summary(quantiles) for key, histogram in self.ops.items()},
+                'parameters': {key: histogram.summary(quantiles) for key, histogram in self.parameters.items()}}
+
+    def to_dict(self) -> dict:
+        return {'bins': list(self.bins),
+                'ops': {key: histogram.to_dict() for key, histogram in self.ops.items()},
+                'parameters': {key: histogram.to_dict() for key, histogram in self.parameters.items()}}
+
+    @staticmethod
+    def from_dict(state: dict) -> 'KQISketch':
+        sketch = KQISketch(*state['bins'])
+        sketch.ops = {key: LogHistogram.from_dict(histogram) for key, histogram in state['ops'].items()}
+        sketch.parameters = {key: LogHistogram.from_dict(histogram) for key, histogram in state['parameters'].items()}
+        return sketch